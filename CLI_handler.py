@@ -34,7 +34,8 @@ def usage():
     usage_ += "'s' : 'crop_square_width', crop the width to equal the height (False by default)\n"
     usage_ += "'t' : 'disable transversalium', disable transversalium correction (False by default)\n"
     usage_ += "'m' : 'mirror flip', mirror flip in x-direction (False by default)\n"
-    usage_ += "'r' : 'w'  crop width to a constant no. of pixels."
+    usage_ += "'r' : 'w'  crop width to a constant no. of pixels.\n"
+    usage_ += "the other options are read from SHG_config.txt (written with the current options)"
     return usage_
     
 def treat_flag_at_cli(options, argument):
@@ -22,11 +22,7 @@ import numpy as np
 import os
 import sys
 import Solex_recon
-import UI_handler
 import CLI_handler
-from astropy.io import fits
-import cProfile
-import PySimpleGUI as sg
 import traceback
 import cv2
 import json
@@ -35,6 +31,7 @@ from multiprocessing import freeze_support
 import glob
 import solex_util
 import video_reader
+# the GUI modules (UI_handler, PySimpleGUI) are only imported in GUI mode, for a faster start of command line runs
 
 serfiles = []
 
@@ -60,7 +57,32 @@ options = {
     'specDir': '',                  # for spectral analyser
     'selected_mode': 'File input mode',
     'continuous_detect_mode': False,#
-    'dispersion':0.05               # for spectral analyser
+    'dispersion':0.05,              # for spectral analyser
+    'single_pass': True,            # read the video once, caching the columns around the line
+    'read_threads': None,           # threads reading each video (None for one per core)
+    'file_workers': None,           # files processed in parallel (None for one per core)
+    'stream_mode': False,           # continuous mode: preview SER files while they are being captured
+    'stream_timeout': 10,           # seconds without new frames before a capture is considered complete
+    'avi_single_channel': False,    # AVI: take the green channel instead of converting to grayscale
+    'ser_byteswap': False,          # SER: byte swap 16-bit data whose header says littleEndian=1 (big-endian for most capture software)
+    'frame_range': None,            # [start, stop, step] of the frames to read (None for all frames)
+    'roi_rows': None,               # [first, last + 1] rows of the image to read (None for all rows)
+    'line_sampling': None,          # SER: detect the line from 1 in N frames, refined until the fit is stable (None for all frames)
+    'analysis_cache_mb': 0,         # size of the cache of raw disks and fits, reused when only output options change (0 to disable)
+    'batch_geometry': 0,            # fit the ellipse on the first N files of a batch, then reuse their median geometry (0 to fit every file)
+    'batch_geometry_tol': 0.01,     # relative rms of the disk edge above which a file gets its own ellipse fit
+    'ellipse_engine': 'canny',      # disk detection: 'canny' (edge detection) or 'radial' (threshold crossings, faster)
+    'fast_warp': True,              # geometric correction with OpenCV on 16-bit data (False: skimage warp)
+    'trans_reference': None,        # shift whose transversalium correction is applied to every shift, e.g. 10 (None: each shift its own)
+    'trans_refine': False,          # with trans_reference: refine the reference correction on each shift
+    'work_dtype': 'float32',        # dtype of the transversalium correction and of the skimage warp ('float64' for more precision, twice the memory)
+    'image_format': 'png',          # format of the output images: 'png' or 'tiff' (16-bit)
+    'png_compression': 0,           # PNG compression level, 0 (fastest, largest files) to 9
+    'fits_compress': False,         # write tile-compressed FITS files
+    'output_threads': 2,            # threads writing the output files in the background (0 to write them immediately)
+    'output_queue': 8,              # maximum number of files waiting to be written
+    'diagnostics': 'data',          # diagnostic figures: 'none', 'data' (NPZ files, see diagnostics.py) or 'png' (rendered in the background)
+    'shift_cube': None,             # with save_fit: 'fits' or 'npy' to write the images of all the shifts in one cube per output (None: one file per shift)
 }
 
 
@@ -136,6 +158,7 @@ def handle_files(files, options, flag_command_line = False):
         traceback.print_exc()
         cv2.destroyAllWindows() # ? TODO needed?
         if not flag_command_line:
+            import PySimpleGUI as sg
             sg.popup_ok('ERROR message: ' + traceback.format_exc()) # show pop_up of error message
 
 def is_openable(file):
@@ -147,6 +170,19 @@ def is_openable(file):
     except:
         return False
 
+def is_streamable(file):
+    try:
+        video_reader.video_reader(file) # header is complete
+        return True
+    except:
+        return False
+
+def stream_files(files, options, preview_callback):
+    for file in files:
+        if file.upper().endswith('.SER'):
+            Solex_recon.solex_stream(file, options, preview_callback)
+    handle_files(files, options, True)
+
 def handle_folder(options):
     if not options['continuous_detect_mode']:
         files_todo = glob.glob(os.path.join(options['input_dir'], '*.ser')) + glob.glob(os.path.join(options['input_dir'], '*.avi'))
@@ -154,6 +190,8 @@ def handle_folder(options):
         handle_files(files_todo, options)
         return
     
+    import PySimpleGUI as sg
+    import UI_handler
     files_processed = set()
     layout = [
         [sg.Text('Auto processing of SHG video files', font='Any 12', key='Auto processing of SHG video files'), sg.Push(), sg.Button('Stop')],
@@ -186,19 +224,29 @@ def handle_folder(options):
 
         if event == '-END SLEEP-':
             files_todo = glob.glob(os.path.join(options['input_dir'], '*.ser')) + glob.glob(os.path.join(options['input_dir'], '*.avi'))
-            files_todo = [x for x in files_todo if not x in files_processed and os.access(x, os.R_OK) and is_openable(x)]
+            # in stream mode, SER files are picked up while they are still being captured
+            files_todo = [x for x in files_todo if not x in files_processed and os.access(x, os.R_OK) and
+                          (is_streamable(x) if options['stream_mode'] and x.upper().endswith('.SER') else is_openable(x))]
             files_todo = files_todo[:min(1, len(files_todo))] # maximum batch size 1
             if files_todo:
                 window['status_info'].update(f'About to process {len(files_todo)} file')
                 prev=files_todo[-1]
-                prev=os.path.join(solex_util.output_path(os.path.splitext(prev)[0] + f'_shift={options["shift"][-1]}_clahe.png', options)).replace('\\', "/")
+                prev=os.path.join(solex_util.image_path(solex_util.output_path(os.path.splitext(prev)[0] + f'_shift={options["shift"][-1]}_clahe.png', options), options)).replace('\\', "/")
                 print('the image file:' + str(prev))
-                window.perform_long_operation(lambda : handle_files(files_todo, options, True), '-END KEY-')
+                if options['stream_mode']:
+                    window.perform_long_operation(lambda : stream_files(files_todo, options, lambda path : window.write_event_value('-PREVIEW-', path)), '-END KEY-')
+                else:
+                    window.perform_long_operation(lambda : handle_files(files_todo, options, True), '-END KEY-')
             else:
                 window['status_info'].update('Looking for files ...')
                 window.perform_long_operation(lambda : time.sleep(1), '-END KEY-')
             files_processed.update(files_todo)
             
+        if event == '-PREVIEW-':
+            window['status_info'].update('Live preview ...')
+            window['_prev_img'].update(data=UI_handler.get_img_data(values['-PREVIEW-'], maxsize=(600,600), first=True))
+            window['last'].update('Live: ' + values['-PREVIEW-'])
+
         if event == 'Stop':
             stop=True
             window['status_info'].update(f'WILL STOP AFTER PROCESSING CURRENT BATCH OF {len(files_todo)} FILE(S)')
@@ -216,15 +264,19 @@ if __name__ == '__main__':
     
     # check for CLI input
     if len(sys.argv)>1: 
+        read_ini() # the options without a command line flag are taken from the config file
         serfiles.extend(CLI_handler.handle_CLI(options))
         
     if 0: #test code for performance test
+        import cProfile
+        import UI_handler
         read_ini()
         serfiles.extend(UI_handler.inputUI(options))
         cProfile.run('handle_files(serfiles, options)', sort='cumtime')
     else:
         # if no command line arguments, open GUI interface
         if len(serfiles)==0:
+            import UI_handler
             # read initial parameters from config.txt file
             read_ini()
             while True:
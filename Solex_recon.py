@@ -12,35 +12,171 @@ Reconstruction of an image from the deviations between the minimum of the line a
 
 from solex_util import *
 from video_reader import *
-from ellipse_to_circle import ellipse_to_circle, correct_image
-from concurrent.futures import ThreadPoolExecutor
-from multiprocessing import Pool
-import PySimpleGUI as sg # for progress bar
+from ellipse_to_circle import ellipse_to_circle, correct_image, correct_images, refine_circle
+from analysis_cache import cache_path, load_read, save_read, load_value, save_value, load_arrays
+import diagnostics
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+import traceback
+import time
 
 
 '''
 process files: call solex_read and solex_proc to process a list of files with specified options
+each file is read and processed inside a worker process, with at most 2 files per worker in flight
+with options['batch_geometry'] = N, the ellipse is fitted on the first N files only, and the median
+of their geometries is reused for the other files (see refine_circle)
 input: tasks: list of tuples (file, option)
 '''
 
 def solex_do_work(tasks, flag_command_line = False):
-    multi = True
-    with Pool(4) as p:
-        results = []
+    if not tasks:
+        return
+    n_batch = tasks[0][1]['batch_geometry']
+    failed = []
+    if n_batch and len(tasks) > n_batch and tasks[0][1]['ratio_fixe'] is None and tasks[0][1]['slant_fix'] is None:
+        results = do_tasks(tasks[:n_batch], flag_command_line, failed, 0, len(tasks))
+        geometries = [r[1] for r in results if r is not None]
+        if geometries:
+            batch_geometry = tuple(float(x) for x in np.median(geometries, axis=0))
+            print('batch geometry (Y/X ratio, tilt angle) : ' + str(batch_geometry))
+            for _, options in tasks[n_batch:]:
+                options['_batch_geometry'] = batch_geometry
+        results += do_tasks(tasks[n_batch:], flag_command_line, failed, n_batch, len(tasks))
+    else:
+        results = do_tasks(tasks, flag_command_line, failed, 0, len(tasks))
+    diagnostics.render_later([path for r in results if r is not None for path in r[2]])
+    if failed:
+        raise Exception('failed to process files: ' + ', '.join(failed))
+
+'''
+process tasks in worker processes (files that fail are added to failed)
+n_before, n_total: for the progress bar
+return the results of solex_do_file, None for the files that failed
+'''
+def do_tasks(tasks, flag_command_line, failed, n_before, n_total):
+    n_workers = min(len(tasks), tasks[0][1]['file_workers'] or os.cpu_count() or 1)
+    show_progress = n_total > 1 and not flag_command_line
+    if show_progress:
+        import PySimpleGUI as sg # for progress bar
+    results = {}
+    if n_workers == 1 or tasks[0][1]['flag_display']: # graphics must stay in this process
         for i, (file, options) in enumerate(tasks):
-            print('file %s is processing'%file)
-            if len(tasks) > 1 and not flag_command_line:  
-                sg.one_line_progress_meter('Progress Bar', i, len(tasks), '','Reading file...')
-            disk_list, backup_bounds, hdr = solex_read(file, options)
-            if multi:
-                result = p.apply_async(solex_process, args = (options, disk_list, backup_bounds, hdr)) # TODO: prints won't be visible inside new thread, can this be fixed?
-                results.append(result)
-            else:
-                solex_process(options, disk_list, backup_bounds, hdr)
-        [result.get() for result in results]
-        if len(tasks) > 1 and not flag_command_line:  
-            sg.one_line_progress_meter('Progress Bar', len(tasks), len(tasks), '','Done.')
+            if show_progress:
+                sg.one_line_progress_meter('Progress Bar', n_before + i, n_total, '','Processing file...')
+            results[i] = solex_do_file(file, options)
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            in_flight = {}
+            todo = list(enumerate(tasks))
+            done_count = n_before
+            while todo or in_flight:
+                while todo and len(in_flight) < 2 * n_workers:
+                    k, (file, options) = todo.pop(0)
+                    if options['read_threads'] is None:
+                        options['read_threads'] = max(1, (os.cpu_count() or 1) // n_workers) # share cores between workers
+                    in_flight[executor.submit(solex_do_file, file, options)] = k, file
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    k, file = in_flight.pop(future)
+                    try:
+                        results[k] = future.result()
+                        print('file %s is done, output: %s' % (file, results[k][0]))
+                    except Exception:
+                        traceback.print_exc()
+                        print('ERROR: failed to process file: ' + file)
+                        failed.append(file)
+                    done_count += 1
+                    if show_progress:
+                        sg.one_line_progress_meter('Progress Bar', done_count, n_total, '','Processing files...')
+    if show_progress and n_before + len(tasks) == n_total:
+        sg.one_line_progress_meter('Progress Bar', n_total, n_total, '','Done.')
+    return [results.get(k) for k in range(len(tasks))]
+
+'''
+read and process one file (run inside a worker process)
+return the paths of the clahe png images produced, the geometry used (Y/X ratio, tilt angle)
+and the diagnostic figures to render
+'''
+def solex_do_file(file, options):
+    print('file %s is processing'%file)
+    try:
+        disk_list, backup_bounds, hdr = solex_read(file, options)
+        outputs = solex_process(options, disk_list, backup_bounds, hdr)
+    finally:
+        flush() # all the outputs of the file are written
+    return outputs, (options['ratio_fixe'], options['slant_fix']), diagnostics.take_saved()
         
+'''
+live capture mode: follow a SER file that is still being written and rebuild a preview image of the
+disk (last requested shift, no geometric correction) as frames arrive
+the line fit is redone on all frames so far until it is stable, then new frames are only reconstructed once
+returns the path of the preview image when the capture is complete (or the file stopped growing)
+preview_callback (optional) is called with the path every time the preview is updated
+'''
+def solex_stream(file, options, preview_callback=None, poll=0.5, preview_interval=2):
+    basefich0 = os.path.splitext(file)[0]
+    preview_path = output_path(basefich0 + '_preview.png', options)
+    quiet_options = options.copy() # line fit on all the frames so far, without log, figures or fits files
+    quiet_options.update({'clahe_only': True, 'save_fit': False, 'flag_display': False, '_nolog': True, 'shift': options['shift'][-1:],
+                          'line_sampling': None})
+    rdr = video_reader(file, byteswap=options['ser_byteswap'])
+    fit, fit_stable, done = None, False, 0
+    disk = np.zeros((rdr.ih, 0), dtype='uint16')
+    last_growth, last_preview = time.time(), 0
+    while True:
+        n_before = rdr.FrameCount
+        complete = rdr.refresh()
+        if rdr.FrameCount > n_before:
+            last_growth = time.time()
+        elif time.time() - last_growth > options['stream_timeout']:
+            complete = True # capture software never wrote the frame count
+        if rdr.FrameCount > done and (complete or time.time() - last_preview > preview_interval):
+            if not fit_stable:
+                try:
+                    rdr.reset()
+                    _, new_fit, _, _ = compute_mean_return_fit(rdr, quiet_options, None, rdr.iw, rdr.ih, basefich0)
+                except Exception:
+                    new_fit = None # not enough of the disk yet
+                if new_fit is not None:
+                    fit_stable = fit is not None and np.max(np.abs(np.sum(np.asarray(new_fit)[:, :2], axis=1) - np.sum(np.asarray(fit)[:, :2], axis=1))) < 0.5
+                    fit, done = new_fit, 0 # rebuild the disk with the new fit
+            if fit is not None:
+                if rdr.FrameCount > disk.shape[1]: # grow the disk by doubling
+                    disk = np.concatenate((disk, np.zeros((rdr.ih, max(rdr.FrameCount, disk.shape[1])), dtype='uint16')), axis=1)
+                ind_l = get_line_columns(fit, quiet_options['shift'][0], rdr.iw)[np.newaxis, :]
+                reconstruct_frames(rdr.get_frames(done, rdr.FrameCount), ind_l, 1 - np.asarray(fit)[:, 1], disk[np.newaxis, :, done:rdr.FrameCount], rdr.scale, rdr.flag_rotate)
+                done = rdr.FrameCount
+                write_preview(disk[:, :done], options, preview_path)
+                last_preview = time.time()
+                if preview_callback:
+                    preview_callback(preview_path)
+        if complete:
+            return preview_path
+        time.sleep(poll)
+
+def write_preview(disk, options, path):
+    if options['flip_x']:
+        disk = np.flip(disk, axis = 1)
+    hi = np.max(disk)
+    img = rescale_brightness(disk, 0, hi) if hi > 0 else disk
+    img = np.rot90(img, options['img_rotate']//90, axes=(0,1))
+    cv2.imwrite(path, img)
+
+'''
+on an analysis cache hit, write the outputs of the line detection of the first read: mean image
+(save_fit) and spectral line figure
+return False if they are wanted but not in the cache entry (the file is then read again)
+'''
+def write_cached_line_outputs(cache, hdr, options, basefich0):
+    mean = load_arrays(cache, 'mean') if options['save_fit'] else None
+    if options['save_fit'] and mean is None:
+        return False
+    if not options['clahe_only'] and not diagnostics.save_cached(output_path(basefich0 + '_spectral_line_data.png', options), 'spectral_line', options):
+        return False
+    if options['save_fit']:
+        write_fits(output_path(basefich0 + '_mean.fits', options), mean['mean'], hdr, options)
+    return True
+
 '''
 read a solex file and return a list of numpy arrays representing the raw result
 '''
@@ -50,17 +186,42 @@ def solex_read(file, options):
     clearlog(basefich0 + '_log.txt', options)
     logme(basefich0 + '_log.txt', options, 'Pixel shift : ' + str(options['shift']))
     options['shift_requested'] = options['shift']
-    options['shift'] = list(dict.fromkeys([10, 0] + options['shift']))  # 10, 0 are "fake", but if they are requested, then don't double count
-    rdr = video_reader(file)
-    hdr = make_header(rdr)
-    ih = rdr.ih
-    iw = rdr.iw
+    reference = [options['trans_reference']] if options['transversalium'] and not options['trans_reference'] is None else []
+    options['shift'] = list(dict.fromkeys([10, 0] + reference + options['shift']))  # 10, 0 are "fake", but if they are requested, then don't double count
+    cache = cache_path(file, options)
+    options['_analysis_cache'] = cache
+    cached = load_read(cache) if cache else None
+    if cached and not write_cached_line_outputs(cache, cached[2], options, basefich0):
+        logme(basefich0 + '_log.txt', options, 'Line detection outputs not in the analysis cache: reading the file again')
+        cached = None
+    if cached:
+        disk_list, (backup_y1, backup_y2), hdr = cached
+        logme(basefich0 + '_log.txt', options, 'Raw disks read from the analysis cache')
+    else:
+        rdr = video_reader(file, single_channel=options['avi_single_channel'], frame_range=options['frame_range'], roi_rows=options['roi_rows'],
+                           byteswap=options['ser_byteswap'])
+        if getattr(rdr, 'big_endian_flag', False):
+            logme(basefich0 + '_log.txt', options, 'SER header littleEndian=1: 16-bit data ' + ('byte swapped' if options['ser_byteswap'] else 'read as little-endian (option ser_byteswap to swap the bytes)'))
+        hdr = make_header(rdr)
+        ih = rdr.ih
+        iw = rdr.iw
 
-    _, fit, backup_y1, backup_y2 = compute_mean_return_fit(video_reader(file), options, hdr, iw, ih, basefich0)
+        # single pass: keep the columns around the spectral line while computing the mean image
+        band = estimate_line_band(rdr, options) if options['single_pass'] and not options['line_sampling'] and rdr.SER_flag else None
+        band_rdr = band_video_reader(rdr, *band) if band else rdr
+        mean_img, fit, backup_y1, backup_y2 = compute_mean_return_fit(band_rdr, options, hdr, iw, ih, basefich0)
 
-    disk_list, ih, iw, FrameCount = read_video_improved(video_reader(file), fit, options)
-    
-    hdr['NAXIS1'] = iw  # note: slightly dodgy, new width for subsequent fits file
+        if band and band_rdr.covers(*get_line_band(fit, options['shift'], iw)):
+            band_rdr.reset() # reconstruct from the cached columns
+            rdr = band_rdr
+        else: # read again only the columns around the line
+            rdr.reset()
+            rdr = video_reader(file, single_channel=options['avi_single_channel'], frame_range=options['frame_range'],
+                               roi_rows=options['roi_rows'], roi_cols=get_line_band(fit, options['shift'], iw), byteswap=options['ser_byteswap'])
+        disk_list, ih, iw, FrameCount = read_video_improved(rdr, fit, options)
+        hdr['NAXIS1'] = iw  # note: slightly dodgy, new width for subsequent fits file
+        if cache:
+            save_read(cache, disk_list, (backup_y1, backup_y2), hdr, fit, mean_img, options)
 
     # sauve fichier disque reconstruit
 
@@ -74,8 +235,7 @@ def solex_read(file, options):
         flag_requested = options['shift'][i] in options['shift_requested']
         
         if options['save_fit'] and flag_requested:
-            DiskHDU = fits.PrimaryHDU(disk_list[i], header=hdr)
-            DiskHDU.writeto(output_path(basefich + '_raw.fits', options), overwrite='True')
+            write_shift_fits(output_path(basefich + '_raw.fits', options), output_path(basefich0 + '_raw', options), options['shift'][i], disk_list[i], hdr, options)
     return disk_list, (backup_y1, backup_y2), hdr
     
 '''
@@ -84,6 +244,7 @@ process the raw disks: circularise, detransversalium, crop, and adjust contrast
 inputs: disk_list : list of images as np arrays
 backup_bounds: tuple of numbers for disk upper and lower bounds (backup for case of no ellipse-fit)
 hdr: an hdr header for fits files
+returns: the paths of the clahe png images
 
 '''
 def solex_process(options, disk_list, backup_bounds, hdr):
@@ -97,6 +258,20 @@ def solex_process(options, disk_list, backup_bounds, hdr):
     logme(basefich0 + '_log.txt', options, f'Protus adjustment : {options["delta_radius"]}')
     borders = [0,0,0,0]
     cercle0 = (-1, -1, -1)
+    outputs = []
+    cache = options.get('_analysis_cache')
+    # the cached fit depends on the options of the fit (always in float64), and with a batch geometry the cached fit
+    # replaces its refinement
+    ellipse_key = (f'ellipse_flip={options["flip_x"]}_engine={options["ellipse_engine"]}'
+                   f'_batch={options.get("_batch_geometry")}_tol={options["batch_geometry_tol"]}')
+    ellipse = load_value(cache, ellipse_key)
+    if ellipse and options['ratio_fixe'] is None and options['slant_fix'] is None and not options['clahe_only'] and not diagnostics.save_cached(
+            output_path(basefich0 + '_shift=' + str(options['shift'][0]) + '_ellipse_fit.png', options), ellipse_key, options):
+        ellipse = None # the figure of the fit is not in the cache: fit again
+    circularized = {} # shift index: corrected image
+    ref = options['trans_reference'] if options['transversalium'] and options['trans_reference'] in options['shift'] else None
+    reference = None # transversalium correction of the reference shift
+    n_stack = max(4, options['read_threads'] or os.cpu_count() or 1) # images corrected together
     for i in range(len(disk_list)):
         flag_requested = options['shift'][i] in options['shift_requested']
         basefich = basefich0 + '_shift=' + str(options['shift'][i])
@@ -105,42 +280,104 @@ def solex_process(options, disk_list, backup_bounds, hdr):
 
         """
         # disk_list[0] is always shift = 10, for more contrast for ellipse fit
-        if options['ratio_fixe'] is None and options['slant_fix'] is None:
+        refined = None
+        if options['ratio_fixe'] is None and options['slant_fix'] is None and not ellipse and options.get('_batch_geometry'):
+            # geometry of the first files of the batch: only find the disk position and radius
+            refined = refine_circle(disk_list[i], options['_batch_geometry'], options, options['batch_geometry_tol'])
+            if refined is None:
+                logme(basefich0 + '_log.txt', options, 'Batch geometry does not fit this disk: full ellipse fit')
+        if refined:
+            frame_circularized, cercle0, borders = refined
+            options['ratio_fixe'], options['slant_fix'] = options['_batch_geometry']
+        elif options['ratio_fixe'] is None and options['slant_fix'] is None and ellipse:
+            cercle0, options['ratio_fixe'], options['slant_fix'], borders = tuple(ellipse['circle']), ellipse['ratio'], ellipse['slant'], ellipse['borders']
+            if flag_requested:
+                frame_circularized = correct_image(disk_list[i], math.radians(options['slant_fix']), options['ratio_fixe'], np.array([-1.0, -1.0]), -1.0, options, print_log=True)[0]
+            logme(basefich0 + '_log.txt', options, 'Ellipse fit read from the analysis cache, disk position, radius : ' + str(cercle0))
+        elif options['ratio_fixe'] is None and options['slant_fix'] is None:
             frame_circularized, cercle0, options['ratio_fixe'], phi, borders = ellipse_to_circle(
-                disk_list[i], options, basefich)
+                disk_list[i], options, basefich, cache_as=ellipse_key)
             # in options angles are stored as degrees (slightly annoyingly)
             options['slant_fix'] = math.degrees(phi)
+            save_value(cache, ellipse_key, {'circle': [float(x) for x in cercle0], 'ratio': float(options['ratio_fixe']),
+                                            'slant': float(options['slant_fix']), 'borders': [float(x) for x in borders]})
 
         else:
             ratio = options['ratio_fixe'] if not options['ratio_fixe'] is None else 1.0
             phi = math.radians(options['slant_fix']) if not options['slant_fix'] is None else 0.0
             if flag_requested:
-                frame_circularized = correct_image(disk_list[i] / 65536, phi, ratio, np.array([-1.0, -1.0]), -1.0, options, print_log=i == 0)[0]  # Note that we assume 16-bit
+                if not i in circularized: # warp this shift and the next requested ones together, with the same maps
+                    todo = [j for j in range(i, len(disk_list)) if options['shift'][j] in options['shift_requested']][:n_stack]
+                    circularized = dict(zip(todo, correct_images([disk_list[j] for j in todo], phi, ratio, options, print_log=i == 0)))  # Note that we assume 16-bit
+                frame_circularized = circularized.pop(i)
 
         if not flag_requested:
             continue # skip processing if shift is not desired
-        
-        single_image_process(frame_circularized, hdr, options, cercle0, borders, basefich, backup_bounds)
+
+        # the transversalium correction depends on the shift, the geometry, the correction strength and on how the
+        # corrected image it is computed from was warped
+        geometry = (f'flip={options["flip_x"]}_strength={options["trans_strength"]}_ratio={options["ratio_fixe"]}_slant={options["slant_fix"]}'
+                    f'_fast_warp={options["fast_warp"]}_dtype={options["work_dtype"]}')
+        trans_name = f'transversalium_shift={options["shift"][i]}_{geometry}'
+        if not ref is None:
+            if reference is None:
+                j = options['shift'].index(ref)
+                ref_img = frame_circularized if j == i else correct_image(disk_list[j], math.radians(options['slant_fix'] or 0.0), options['ratio_fixe'] or 1.0,
+                                                                          np.array([-1.0, -1.0]), -1.0, options)[0]
+                reference = reference_transversalium(ref_img, options, cercle0, borders, backup_bounds, f'transversalium_shift={ref}_{geometry}')
+                logme(basefich0 + '_log.txt', options, f'Transversalium correction computed on shift {ref}' + (', refined on each shift' if options['trans_refine'] else ''))
+            trans_name = f'transversalium_shift={options["shift"][i]}_reference={ref}_{geometry}' if options['trans_refine'] else None
+        single_image_process(frame_circularized, hdr, options, cercle0, borders, basefich, backup_bounds, trans_name, reference, options['shift'][i])
         write_complete(basefich0 + '_log.txt', options)
+        outputs.append(image_path(output_path(basefich + '_clahe.png', options), options))
+    return outputs
 
 
-def single_image_process(frame_circularized, hdr, options, cercle0, borders, basefich, backup_bounds):
+# disk (or band between the backup bounds) on which the transversalium correction is computed
+def transversalium_bounds(img, cercle0, borders, backup_bounds):
+    if not cercle0 == (-1, -1, -1):
+        return cercle0, borders
+    return (0,0,99999), [0, backup_bounds[0]+20, img.shape[1] -1, backup_bounds[1]-20]
+
+'''
+transversalium correction factors of the reference shift, applied to every other shift
+trans_name: name of the correction in the analysis cache
+'''
+def reference_transversalium(img, options, cercle0, borders, backup_bounds, trans_name):
+    cache = options.get('_analysis_cache')
+    correction = load_value(cache, trans_name)
+    if correction is None:
+        correction = transversalium_correction(img, *transversalium_bounds(img, cercle0, borders, backup_bounds), options)
+        save_value(cache, trans_name, correction.tolist())
+    return np.asarray(correction)
+
+# reference: correction factors of the reference shift (None to compute the correction of each shift)
+# shift: pixel shift of the image, for options['shift_cube']
+def single_image_process(frame_circularized, hdr, options, cercle0, borders, basefich, backup_bounds, trans_name=None, reference=None, shift=None):
     if options['save_fit']:  # first two shifts are not user specified
-        DiskHDU = fits.PrimaryHDU(frame_circularized, header=hdr)
-        DiskHDU.writeto(output_path(basefich + '_circular.fits', options), overwrite='True')
+        write_shift_fits(output_path(basefich + '_circular.fits', options), output_path(options['basefich0'] + '_circular', options), shift, frame_circularized, hdr, options)
 
 
     if options['transversalium']:
-        if not cercle0 == (-1, -1, -1):
-            detransversaliumed = correct_transversalium2(frame_circularized, cercle0, borders, options, 0, basefich)
-        else:
-            detransversaliumed = correct_transversalium2(frame_circularized, (0,0,99999), [0, backup_bounds[0]+20, frame_circularized.shape[1] -1, backup_bounds[1]-20], options, 0, basefich)
+        cache = options.get('_analysis_cache')
+        correction = load_value(cache, trans_name) if trans_name else None
+        circle, trans_borders = transversalium_bounds(frame_circularized, cercle0, borders, backup_bounds)
+        if correction is None and not reference is None:
+            if options['trans_refine']: # residual correction of this shift, once the reference one is applied
+                residual = transversalium_correction((frame_circularized.T * reference).T, circle, trans_borders, options)
+                correction = reference * residual
+                if trans_name:
+                    save_value(cache, trans_name, correction.tolist())
+            else:
+                correction = reference
+        detransversaliumed = correct_transversalium2(frame_circularized, circle, trans_borders, options, 0, basefich, correction)
+        if trans_name and correction is None:
+            save_value(cache, trans_name, options['_transversalium_cache'].tolist())
     else:
         detransversaliumed = frame_circularized
 
     if options['save_fit'] and options['transversalium']:  # first two shifts are not user specified
-        DiskHDU = fits.PrimaryHDU(detransversaliumed, header=hdr)
-        DiskHDU.writeto(output_path(basefich + '_detransversaliumed.fits', options), overwrite='True')
+        write_shift_fits(output_path(basefich + '_detransversaliumed.fits', options), output_path(options['basefich0'] + '_detransversaliumed', options), shift, to_uint16(detransversaliumed), hdr, options)
 
     cercle = cercle0
     if not options['fixed_width'] == None or options['crop_width_square']:
@@ -63,6 +63,7 @@ def interpret_UI_values(options, ui_values, no_file = False):
     if options['selected_mode'] == 'Folder input mode':
         options['input_dir'] = ui_values['input_dir']
     options['continuous_detect_mode'] = ui_values['Continuous detect mode']
+    options['stream_mode'] = ui_values['Live stream mode']
 
     if not no_file:
         if options['selected_mode'] == 'File input mode':
@@ -126,7 +127,7 @@ def get_img_data(f, maxsize=(30, 18), first=False):
 
 def change_langs(window, popup_messages, lang_dict, flag_change=True):
     flag_ok = 0
-    checkboxes = set(['Show graphics', 'Save fits files', 'Save clahe.png only', 'Crop square', 'Mirror X', 'Correct transversalium lines', 'Continuous detect mode'])
+    checkboxes = set(['Show graphics', 'Save fits files', 'Save clahe.png only', 'Crop square', 'Mirror X', 'Correct transversalium lines', 'Continuous detect mode', 'Live stream mode'])
     popup_ids = set(['no_file_error', 'no_folder_error'])
     for k, v in lang_dict.items():
         if k == '_flag_icon':
@@ -178,6 +179,7 @@ def inputUI(options):
         [sg.Text('Folder', size=(7, 1), key = 'Folder'), sg.InputText(default_text='',size=(75,1),key='input_dir'),
          sg.FolderBrowse('Choose input folder', key = 'Choose input folder', initial_folder=options['input_dir'])],
         [sg.Checkbox('Continuous detect mode', default=options['continuous_detect_mode'], key='Continuous detect mode')],
+        [sg.Checkbox('Live stream mode', default=options['stream_mode'], key='Live stream mode')],
     ]
 
     layout_folder_output = [
@@ -0,0 +1,167 @@
+"""
+@author: Andrew Smith
+contributors: Valerie Desnoux, Matt Considine
+Version 6 August 2023
+
+--------------------------------------------------------------
+On-disk cache of the analysis of each video file
+- the reconstructed raw disks, line fit and disk bounds of solex_read
+- small analysis results of solex_process (ellipse fit, transversalium correction)
+- the mean image and the data of the diagnostic figures, written again when the analysis is
+  read from the cache so that a rerun gives the same outputs
+entries are keyed by the size, modification time and header of the file and by the options
+that change the raw disks, so changing only output options reuses the analysis
+the cache is bounded in size: the least recently used entries are removed first
+--------------------------------------------------------------
+"""
+import os
+import sys
+import json
+import hashlib
+import traceback
+import numpy as np
+from astropy.io import fits
+
+CACHE_VERSION = 1
+
+# options which change the raw disks
+READ_OPTIONS = ['shift', 'frame_range', 'roi_rows', 'line_sampling', 'avi_single_channel', 'ser_byteswap']
+
+def cache_dir():
+    return os.path.join(os.path.dirname(sys.argv[0]), 'SHG_cache')
+
+'''
+return the path (without extension) of the cache entry of a file for these options,
+or None if the cache is disabled
+'''
+def cache_path(file, options):
+    if not options['analysis_cache_mb']:
+        return None
+    st = os.stat(file)
+    with open(file, 'rb') as f:
+        header = f.read(178) # SER header (or the start of an AVI file)
+    key = {'version': CACHE_VERSION, 'file': os.path.abspath(file), 'size': st.st_size, 'mtime': st.st_mtime_ns,
+           'header': hashlib.sha1(header).hexdigest()}
+    key.update({k: options[k] for k in READ_OPTIONS})
+    return os.path.join(cache_dir(), hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest())
+
+def load_meta(path):
+    try:
+        with open(path + '.json', 'r', encoding="utf-8") as fp:
+            return json.load(fp)
+    except Exception:
+        return {}
+
+def save_meta(path, meta):
+    with open(path + '.json.tmp', 'w', encoding="utf-8") as fp:
+        json.dump(meta, fp)
+    os.replace(path + '.json.tmp', path + '.json')
+
+'''
+return disk_list, backup_bounds, hdr as saved by save_read, or None if not in the cache
+'''
+def load_read(path):
+    meta = load_meta(path)
+    if not 'backup_bounds' in meta:
+        return None
+    try:
+        disk_cube = np.load(path + '.npy')
+    except Exception:
+        return None
+    touch(path)
+    return list(disk_cube), tuple(meta['backup_bounds']), fits.Header.fromstring(meta['hdr'])
+
+def save_read(path, disk_list, backup_bounds, hdr, fit, mean_img, options):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.npy.tmp', 'wb') as fp:
+            np.save(fp, np.array(disk_list))
+        os.replace(path + '.npy.tmp', path + '.npy')
+        save_arrays(path, 'mean', mean=mean_img)
+        save_meta(path, {'backup_bounds': [int(x) for x in backup_bounds], 'hdr': hdr.tostring(),
+                         'fit': np.asarray(fit).tolist()})
+        evict(options['analysis_cache_mb'] * 1024 * 1024)
+    except Exception:
+        traceback.print_exc()
+        print('ERROR: failed to write analysis cache: ' + path)
+
+'''
+small analysis results (json values) stored next to the raw disks of an entry
+'''
+def load_value(path, name):
+    return load_meta(path).get(name) if path else None
+
+def save_value(path, name, value):
+    if not path:
+        return
+    try:
+        meta = load_meta(path)
+        if not meta: # entry was evicted
+            return
+        meta[name] = value
+        save_meta(path, meta)
+    except Exception:
+        traceback.print_exc()
+        print('ERROR: failed to write analysis cache: ' + path)
+
+'''
+named arrays (npz file) stored next to the raw disks of an entry
+'''
+def load_arrays(path, name):
+    if not path:
+        return None
+    try:
+        with np.load(path + '_' + name + '.npz') as d:
+            return {k: d[k] for k in d.files}
+    except Exception:
+        return None
+
+def save_arrays(path, name, **arrays):
+    if not path:
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '_' + name + '.npz.tmp', 'wb') as fp:
+            np.savez(fp, **arrays)
+        os.replace(path + '_' + name + '.npz.tmp', path + '_' + name + '.npz')
+    except Exception:
+        traceback.print_exc()
+        print('ERROR: failed to write analysis cache: ' + path)
+
+# files of the entries in the cache: {entry: [file names]}
+def entry_files():
+    entries = {}
+    for name in os.listdir(cache_dir()):
+        if not name.endswith('.tmp'):
+            entries.setdefault(name.split('.')[0].split('_')[0], []).append(name)
+    return entries
+
+def touch(path):
+    for name in entry_files().get(os.path.basename(path), []):
+        try:
+            os.utime(os.path.join(cache_dir(), name))
+        except OSError:
+            pass
+
+# remove the least recently used entries until the cache fits in max_bytes
+def evict(max_bytes):
+    entries = {}
+    for base, names in entry_files().items():
+        size, mtime = 0, 0
+        for name in names:
+            try:
+                st = os.stat(os.path.join(cache_dir(), name))
+            except OSError:
+                continue # removed by another process
+            size, mtime = size + st.st_size, max(mtime, st.st_mtime)
+        entries[base] = (size, mtime, names)
+    total = sum(size for size, _, _ in entries.values())
+    for base, (size, _, names) in sorted(entries.items(), key=lambda x: x[1][1]):
+        if total <= max_bytes:
+            break
+        for name in names:
+            try:
+                os.remove(os.path.join(cache_dir(), name))
+            except OSError:
+                pass
+        total -= size
@@ -0,0 +1,61 @@
+"""
+Benchmark of the disk detection engines of ellipse_to_circle ('canny' and 'radial'):
+accuracy of the Y/X ratio and tilt angle, and runtime, on synthetic limb-darkened discs of
+known geometry, with noise and a few bright spots outside the disc
+
+usage: python benchmarks/bench_ellipse.py [number of discs]
+"""
+import os
+import sys
+import io
+import math
+import time
+import contextlib
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ellipse_to_circle import find_ellipse, normalise_axes
+
+
+# disc image (scaled to [0, 1]) with semi-axes width, height along axes rotated by phi, in the
+# (y, x) coordinates of the fitted points (same convention as LsqEllipse.as_parameters)
+def synthetic_disc(shape, center, width, height, phi, rng):
+    y, x = np.mgrid[:shape[0], :shape[1]].astype('float')
+    u = (y - center[0]) * math.cos(phi) + (x - center[1]) * math.sin(phi)
+    v = -(y - center[0]) * math.sin(phi) + (x - center[1]) * math.cos(phi)
+    rho2 = (u / width)**2 + (v / height)**2
+    limb = np.sqrt(np.clip(1 - rho2, 0, 1))**0.5
+    img = np.where(rho2 < 1, 0.4 + 0.5 * limb, 0.08) * 0.6
+    for _ in range(5): # prominences and hot pixels outside the disc
+        py, px = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        img[max(0, py - 3):py + 3, max(0, px - 3):px + 3] += 0.2
+    img += rng.normal(0, 0.01, shape)
+    return np.clip(img, 0, 1)
+
+def main(n):
+    rng = np.random.default_rng(0)
+    errors = {'canny': [], 'radial': []}
+    times = {'canny': 0.0, 'radial': 0.0}
+    for i in range(n):
+        height = rng.uniform(500, 800)
+        ratio = rng.choice([-1, 1]) * rng.uniform(0.05, 0.25) + 1 # the tilt is not defined for a circle
+        phi = math.radians(rng.uniform(-10, 10))
+        shape = (int(2.5 * height), int(2.5 * height))
+        center = (shape[0] / 2 + rng.uniform(-30, 30), shape[1] / 2 + rng.uniform(-30, 30))
+        img = synthetic_disc(shape, center, height * ratio, height, phi, rng)
+        _, true_phi, true_ratio = normalise_axes(height * ratio, height, phi)
+        for engine in errors:
+            t = time.time()
+            with contextlib.redirect_stdout(io.StringIO()): # the canny engine is verbose
+                _, _, fit_phi, fit_ratio, _, _, _ = find_ellipse(img, {'ellipse_engine': engine})
+            times[engine] += time.time() - t
+            errors[engine].append((abs(fit_ratio - true_ratio), abs(math.degrees(fit_phi - true_phi))))
+    print(f'{n} discs')
+    print('engine    time per disc (s)    ratio error mean / max    tilt error mean / max (degrees)')
+    for engine in errors:
+        e = np.array(errors[engine])
+        print(f'{engine:8s}  {times[engine] / n:17.3f}    {np.mean(e[:, 0]):.4f} / {np.max(e[:, 0]):.4f}' +
+              f'           {np.mean(e[:, 1]):.3f} / {np.max(e[:, 1]):.3f}')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
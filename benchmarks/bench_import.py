@@ -0,0 +1,41 @@
+"""
+Benchmark of the start-up time of the command line: time to import each module of the
+processing chain in a fresh interpreter (median of several runs), and the slow optional
+packages (GUI toolkits, matplotlib...) that the import pulls in
+
+usage: python benchmarks/bench_import.py [number of runs]
+"""
+import os
+import sys
+import json
+import subprocess
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = ['video_reader', 'solex_util', 'ellipse_to_circle', 'Solex_recon', 'SHG_MAIN', 'UI_handler']
+OPTIONAL = ['PySimpleGUI', 'tkinter', 'matplotlib', 'PIL', 'scipy.signal', 'skimage.feature', 'skimage.transform', 'scipy.spatial']
+
+# run in the child interpreter: time of the import and optional packages loaded
+CHILD = '''
+import sys, time, json
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+print(json.dumps([t, [m for m in {optional} if m in sys.modules]]))
+'''
+
+def time_import(module):
+    out = subprocess.run([sys.executable, '-c', CHILD.format(module=module, optional=OPTIONAL)], cwd=ROOT,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+def main(n):
+    print(f'{n} runs')
+    print('module               import time (s)    optional packages loaded')
+    for module in MODULES:
+        runs = [time_import(module) for _ in range(n)]
+        print(f'{module:20s} {np.median([t for t, _ in runs]):15.3f}    {", ".join(runs[0][1]) or "-"}')
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
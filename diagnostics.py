@@ -0,0 +1,147 @@
+"""
+@author: Andrew Smith
+contributors: Valerie Desnoux, Matt Considine
+Version 6 August 2023
+
+--------------------------------------------------------------
+Diagnostic figures: spectral line detection, ellipse fit and transversalium correction
+- the data of each figure is saved as a small NPZ file next to the outputs (images downsampled
+  to at most MAX_SIZE pixels, point sets to at most MAX_POINTS points)
+- options['diagnostics']: 'none', 'data' (NPZ files only) or 'png' (the PNG figures are also rendered
+  from the NPZ files, in a background process once the files are processed)
+- NPZ files can be rendered later with: python diagnostics.py file.npz ...
+- the data of the figures of the line detection and the ellipse fit is also kept in the analysis
+  cache, to save the figures again when the analysis is read from the cache
+--------------------------------------------------------------
+"""
+import os
+import sys
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from output_writer import submit
+from analysis_cache import load_arrays, save_arrays
+
+MAX_SIZE = 1024
+MAX_POINTS = 2000
+DPI = 150
+
+saved = [] # NPZ files saved by this process, to render
+renderer = None
+
+# image subsampled to at most MAX_SIZE pixels along each axis, as 8-bit (only displayed)
+def small_image(img):
+    step = -(-max(img.shape) // MAX_SIZE)
+    small = img[::step, ::step].astype('float32')
+    lo, hi = np.min(small), np.max(small)
+    return ((small - lo) * (255 / max(hi - lo, 1e-12))).astype(np.uint8)
+
+def few_points(points):
+    step = -(-len(points) // MAX_POINTS)
+    return points[::max(1, step)]
+
+'''
+save the data of a figure
+path: path of the PNG figure, the data is saved with the .npz extension
+kind: 'spectral_line', 'ellipse_fit' or 'transversalium'
+cache_as: name of the data in the analysis cache entry of the file (see save_cached), None to not cache it
+'''
+def save(path, kind, options, cache_as=None, **data):
+    if cache_as:
+        save_arrays(options.get('_analysis_cache'), cache_as, kind=kind, **data)
+    if not options['diagnostics'] in ('data', 'png'):
+        return
+    path = os.path.splitext(path)[0] + '.npz'
+    submit(path, options, np.savez_compressed, path, kind=kind, **data)
+    if options['diagnostics'] == 'png':
+        saved.append(path)
+
+'''
+save again a figure whose data was cached as name, when its analysis is read from the cache
+return False if the figure is wanted but its data is not in the cache
+'''
+def save_cached(path, name, options):
+    if not options['diagnostics'] in ('data', 'png'):
+        return True
+    data = load_arrays(options.get('_analysis_cache'), name)
+    if data is None:
+        return False
+    save(path, str(data.pop('kind')), options, **data)
+    return True
+
+# NPZ files saved since the last call
+def take_saved():
+    paths = saved[:]
+    saved.clear()
+    return paths
+
+# render figures in a background process, without waiting for them
+def render_later(paths):
+    global renderer
+    if not paths:
+        return
+    if renderer is None:
+        renderer = ProcessPoolExecutor(max_workers=1)
+    for path in paths:
+        renderer.submit(render, path)
+
+# extent of an image subsampled from an image of this shape, in the pixels of the full image
+def extent(shape):
+    return (-0.5, shape[1] - 0.5, shape[0] - 0.5, -0.5)
+
+def plot_spectral_line(fig, d):
+    ax = fig.add_subplot(1, 1, 1)
+    ax.imshow(d['image'], cmap='gray', extent=extent(d['shape']))
+    ax.plot(d['x'], d['y'], 'rx', label='line detection')
+    ax.plot(d['curve'], np.arange(len(d['curve'])), label='polynomial fit')
+    ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
+    ax.set_aspect(0.1)
+    fig.tight_layout()
+
+def plot_ellipse_fit(fig, d):
+    ax = [[fig.add_subplot(2, 2, 1), fig.add_subplot(2, 2, 2)], [fig.add_subplot(2, 2, 3), fig.add_subplot(2, 2, 4)]]
+    fig.tight_layout()
+    ax[0][0].imshow(d['image'], cmap='gray', extent=extent(d['shape']))
+    ax[0][0].set_title('uncorrected image', fontsize=11)
+    ax[0][0].set_aspect('equal')
+    ax[0][1].set_aspect('equal')
+    ax[0][1].imshow(d['image'], cmap='gray', extent=extent(d['shape']))
+    ax[0][1].plot(d['raw_X'][:, 1], d['raw_X'][:, 0], 'ro', label='edge detection')
+    ax[0][1].legend(prop={'size': 6})
+    ax[1][1].set_aspect('equal')
+    ax[1][1].plot(d['X_f'][:, 1], d['X_f'][:, 0], 'ro', label='filtered edges')
+    ax[1][1].plot(d['ellipse_points'][:, 1], d['ellipse_points'][:, 0], color='b', label='ellipse fit')
+    ax[1][1].set_ylim([d['shape'][0], 0])  # make y-axis upside-down
+    ax[1][1].legend(prop={'size': 6})
+    ax[1][0].set_aspect('equal')
+    ax[1][0].imshow(d['fix_img'], cmap='gray', extent=extent(d['fix_shape']))
+    borders = d['borders']
+    ax[1][0].axhline(y=borders[1])
+    ax[1][0].axhline(y=borders[3])
+    ax[1][0].axvline(x=borders[0])
+    ax[1][0].axvline(x=borders[2])
+    ax[1][0].set_title('geometrically corrected image', fontsize=11)
+
+def plot_transversalium(fig, d):
+    ax = fig.add_subplot(1, 1, 1)
+    ax.plot(d['correction'])
+    ax.set_xlabel('y')
+    ax.set_ylabel('transversalium correction factor')
+
+plots = {'spectral_line': plot_spectral_line, 'ellipse_fit': plot_ellipse_fit, 'transversalium': plot_transversalium}
+
+# render the PNG figure of an NPZ file
+def render(path):
+    try:
+        import matplotlib.figure
+        with np.load(path) as d:
+            fig = matplotlib.figure.Figure()
+            plots[str(d['kind'])](fig, d)
+            fig.savefig(os.path.splitext(path)[0] + '.png', dpi=DPI)
+    except Exception:
+        traceback.print_exc()
+        print('ERROR: failed to render diagnostic figure: ' + path)
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        render(path)
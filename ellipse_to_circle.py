@@ -6,27 +6,21 @@ Version 6 August 2023
 """
 from numpy import polynomial
 from solex_util import *
+from solex_util import work_dtype, output_path
 
-import skimage
-import skimage.feature
-import skimage.data._fetchers
+import os
 import sys
 
 import math
 import numpy as np
-import matplotlib.figure
-import matplotlib.pyplot
 
-from skimage import data
-from skimage import transform
-from skimage import filters
-from skimage.transform import downscale_local_mean
 import cv2
 
-import scipy
 from ellipse import LsqEllipse
-from matplotlib.patches import Ellipse
-from scipy.spatial import ConvexHull
+from concurrent.futures import ThreadPoolExecutor
+import diagnostics
+# skimage.feature, skimage.transform, scipy.ndimage and scipy.spatial are imported by the functions
+# which use them: they are not needed when the geometry is known
 
 NUM_REG = 2  # 6 # include biggest NUM_REG regions in fit
              # for multiple full-disk scans this must be changed to 1
@@ -76,6 +70,14 @@ def two_step(points):
     Xr = mat @ (points_tresholded - np.array(center)).T * height
     values = np.linalg.norm(Xr, axis=0) - 1
     #print(np.mean(values), np.std(values), max(values), min(values))
+    height, phi, ratio = normalise_axes(width, height, phi)
+    return np.array(
+        center), height, phi, ratio, points_tresholded, ellipse_points
+
+def normalise_axes(width, height, phi):
+    """IN : ellipse axes and angle, as returned by LsqEllipse
+    OUT : height, phi, ratio with phi close to 0 (within pi/4)
+    """
     ratio = width / height
     #try to get phi close to 0 (within pi/4) by swapping the semi-major and semi-minor axes labels
     for _ in range(2):
@@ -87,63 +89,227 @@ def two_step(points):
             phi += math.pi/2
             ratio = 1/ratio
             height = height / ratio
-    return np.array(
-        center), height, phi, ratio, points_tresholded, ellipse_points
+    return height, phi, ratio
 
-# note: height is actually an ellipse axis
-def correct_image(image, phi, ratio, center, height, options, print_log=False):
-    """correct image geometry. TODO : a rotation is made instead of a tilt
-    IN : numpy array, float, float, numpy array (2 elements)
-    OUT : numpy array, numpy array (2 elements)
+
+def direct_ellipse_fit(points, weights):
+    """weighted direct least squares ellipse fit (Halir and Flusser, as LsqEllipse)
+    IN : numpy array of points (normalised coordinates), weight of each point
+    OUT : conic coefficients [a, b, c, d, e, f] of a x**2 + b xy + c y**2 + d x + e y + f = 0
+    """
+    x, y = points.T
+    w = np.sqrt(weights)
+    D1 = np.stack([x**2, x*y, y**2], axis=1) * w[:, np.newaxis]
+    D2 = np.stack([x, y, np.ones_like(x)], axis=1) * w[:, np.newaxis]
+    S1, S2, S3 = D1.T @ D1, D1.T @ D2, D2.T @ D2
+    T = -np.linalg.solve(S3, S2.T)
+    M = S1 + S2 @ T
+    M = np.array([M[2] / 2, -M[1], M[0] / 2]) # inverse of the constraint matrix
+    eigval, eigvec = np.linalg.eig(M)
+    cond = 4 * eigvec[0] * eigvec[2] - eigvec[1]**2
+    if not np.any(cond > 0):
+        raise Exception('error no ellipse found in the limb points')
+    a1 = np.real(eigvec[:, np.argmax(cond > 0)])
+    return np.concatenate((a1, T @ a1))
+
+def conic_parameters(coef):
+    """centre, axes and tilt of an ellipse from its conic coefficients (same conventions as LsqEllipse.as_parameters)
+    IN : conic coefficients [a, b, c, d, e, f] of a x**2 + b xy + c y**2 + d x + e y + f = 0
+    OUT : center, width, height, phi
     """
+    a, b, c, d, f, g = coef[0], coef[1] / 2, coef[2], coef[3] / 2, coef[4] / 2, coef[5]
+    center = ((c*d - b*f) / (b**2 - a*c), (a*f - b*d) / (b**2 - a*c))
+    numerator = 2 * (a*f**2 + c*d**2 + g*b**2 - 2*b*d*f - a*c*g)
+    root = np.sqrt((a - c)**2 + 4*b**2)
+    height = np.sqrt(numerator / ((b**2 - a*c) * (root - (c + a))))
+    width = np.sqrt(numerator / ((b**2 - a*c) * (-root - (c + a))))
+    if a == c:
+        phi = 0.0 # circle: any angle
+    elif b == 0:
+        phi = 0.0 if a > c else np.pi/2
+    else:
+        phi = 0.5 * np.arctan(2*b / (a - c)) + (0 if a > c else np.pi/2)
+    return center, width, height, phi
 
+def robust_ellipse_fit(points, n_iter=10):
+    """iteratively reweighted direct ellipse fit (Tukey weights on the Sampson distance)
+    IN : numpy array of (y, x) points
+    OUT : center, width, height, phi as LsqEllipse.as_parameters, mask of the inlier points
+    """
+    mean, scale = np.mean(points, axis=0), np.std(points)
+    p = (points - mean) / scale
+    weights = np.ones(p.shape[0])
+    for _ in range(n_iter):
+        coef = direct_ellipse_fit(p, weights)
+        a, b, c, d, e, f = coef
+        x, y = p.T
+        q = a*x**2 + b*x*y + c*y**2 + d*x + e*y + f
+        grad = np.hypot(2*a*x + b*y + d, b*x + 2*c*y + e)
+        dist = q / np.maximum(grad, 1e-12) # Sampson distance
+        s = 1.4826 * np.median(np.abs(dist)) + 1e-12
+        u = dist / (4.685 * s)
+        weights = np.where(np.abs(u) < 1, (1 - u**2)**2, 0)
+    center, width, height, phi = conic_parameters(coef)
+    return np.array(center) * scale + mean, width * scale, height * scale, phi, weights > 0
+
+def threshold_crossings(image, thresh):
+    """sub-pixel positions where each row of the image first rises above and last falls below thresh
+    (rows where the crossing would be at the side of the image are skipped)
+    OUT : numpy arrays of rows and positions
+    """
+    mask = image > thresh
+    rows = np.nonzero(np.any(mask, axis=1))[0]
+    w = image.shape[1]
+    first = np.argmax(mask[rows], axis=1)
+    last = w - 1 - np.argmax(mask[rows, ::-1], axis=1)
+    k1, k2 = first > 0, last < w - 1
+    r1, f = rows[k1], first[k1]
+    lo, hi = image[r1, f - 1], image[r1, f]
+    pos1 = f - 1 + (thresh - lo) / np.maximum(hi - lo, 1e-12)
+    r2, l = rows[k2], last[k2]
+    hi, lo = image[r2, l], image[r2, l + 1]
+    pos2 = l + (hi - thresh) / np.maximum(hi - lo, 1e-12)
+    return np.concatenate((r1, r2)), np.concatenate((pos1, pos2))
+
+def get_limb_points(image):
+    """limb points of the disk: threshold crossings along the rows and the columns of the image,
+    with a threshold from the Otsu threshold of the blurred image (no edge detection)
+    IN : numpy array (down-scaled image)
+    OUT : numpy array of (y, x) points
+    """
+    blur = cv2.blur(image.astype('float32'), ksize=(3, 3))
+    lo, hi = np.min(blur), np.max(blur)
+    img8 = ((blur - lo) * (255 / max(hi - lo, 1e-12))).astype(np.uint8)
+    thresh8, _ = cv2.threshold(img8, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    otsu = lo + (thresh8 + 0.5) * (hi - lo) / 255
+    # the limb is darker than the mean of the disk: halfway between the background and the Otsu threshold
+    thresh = (np.mean(blur[blur <= otsu]) + otsu) / 2
+    rows, x = threshold_crossings(blur, thresh)
+    cols, y = threshold_crossings(blur.T, thresh)
+    return np.concatenate((np.stack((rows, x), axis=1), np.stack((y, cols), axis=1))).astype('float')
+
+def radial_fit(points):
+    """robust ellipse fit of the limb points, in the same form as two_step
+    IN : numpy array of (y, x) limb points
+    OUT : np.array(center), height, phi, ratio, inlier points, ellipse_points
+    """
+    center, width, height, phi, inliers = robust_ellipse_fit(points)
+    t = np.linspace(0, 2*np.pi, 100)
+    ellipse_points = np.stack((center[0] + width * np.cos(t) * np.cos(phi) - height * np.sin(t) * np.sin(phi),
+                               center[1] + width * np.cos(t) * np.sin(phi) + height * np.sin(t) * np.cos(phi)), axis=1)
+    height, phi, ratio = normalise_axes(width, height, phi)
+    return center, height, phi, ratio, points[inliers], ellipse_points
+
+# size of the corrected image and transform (mat3: inverse of the transform, from corrected to original coordinates)
+def correction_geometry(shape, phi, ratio):
     mat, theta = get_correction_matrix(phi, ratio) 
     mat3 = np.zeros((3, 3))
     mat3[:2, :2] = mat
     mat3[2, 2] = 1
-    corners = np.array([[0, 0], [0, image.shape[0]], [image.shape[1], 0], [
-                       image.shape[1], image.shape[0]]])
+    corners = np.array([[0, 0], [0, shape[0]], [shape[1], 0], [
+                       shape[1], shape[0]]])
     # use inverse because we represent mat3 as inverse of transform
     new_corners = (np.linalg.inv(mat) @ corners.T).T
     new_h = np.max(new_corners[:, 1]) - np.min(new_corners[:, 1])
     new_w = np.max(new_corners[:, 0]) - np.min(new_corners[:, 0])
     mat3 = mat3 @ np.array([[1, 0, np.min(new_corners[:, 0])], [0, 1, np.min(
         new_corners[:, 1])], [0, 0, 1]])  # apply translation to prevent clipping
-    my_transform = transform.ProjectiveTransform(matrix=mat3)
-    corrected_img = transform.warp(image, my_transform, output_shape=(
-        np.ceil(new_h), np.ceil(new_w)), cval=image[0, 0])
-    corrected_img = (
-        2**16 *
-        corrected_img).astype(
-        np.uint16)  # note : 16-bit output
+    output_shape = (int(np.ceil(new_h)), int(np.ceil(new_w)))
+    return mat, theta, mat3, new_corners, output_shape
+
+# cv2.remap maps of the current geometry (all the shifts of a file share them)
+correction_maps = {}
+
+def get_correction_maps(shape, mat3, output_shape):
+    key = (shape, output_shape, mat3.tobytes())
+    if not key in correction_maps:
+        correction_maps.clear() # only keep the maps of one geometry
+        ys, xs = np.mgrid[:output_shape[0], :output_shape[1]]
+        map_x = mat3[0, 0] * xs + mat3[0, 1] * ys + mat3[0, 2]
+        map_y = mat3[1, 0] * xs + mat3[1, 1] * ys + mat3[1, 2]
+        correction_maps[key] = (map_x.astype(np.float32), map_y.astype(np.float32))
+    return correction_maps[key]
+
+def use_fast_warp(shape, output_shape, options):
+    return options['fast_warp'] and max(output_shape + shape) < 32767 # OpenCV size limit
+
+# bilinear warp with OpenCV, on the 16-bit values in float32 (truncated to 16-bit as the skimage path)
+def warp_image(image, maps):
+    src = image.astype(np.float32) if image.dtype == np.uint16 else (2**16 * image).astype(np.float32)
+    corrected_img = cv2.remap(src, maps[0], maps[1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=float(src[0, 0]))
+    return np.clip(corrected_img, 0, 65535).astype(np.uint16)  # note : 16-bit output
+
+# note: height is actually an ellipse axis
+def correct_image(image, phi, ratio, center, height, options, print_log=False):
+    """correct image geometry. TODO : a rotation is made instead of a tilt
+    IN : numpy array (uint16, or float scaled to [0, 1]), float, float, numpy array (2 elements)
+    OUT : numpy array, numpy array (2 elements)
+    """
+
+    mat, theta, mat3, new_corners, output_shape = correction_geometry(image.shape, phi, ratio)
+    if use_fast_warp(image.shape, output_shape, options):
+        # the transform is affine: OpenCV warp with cached maps
+        corrected_img = warp_image(image, get_correction_maps(image.shape, mat3, output_shape))
+    else:
+        if image.dtype == np.uint16:
+            image = image.astype(work_dtype(options)) / 65536
+        from skimage import transform
+        my_transform = transform.ProjectiveTransform(matrix=mat3)
+        corrected_img = transform.warp(image, my_transform, output_shape=output_shape, cval=image[0, 0])
+        corrected_img = (
+            2**16 *
+            corrected_img).astype(
+            np.uint16)  # note : 16-bit output
     new_center = (np.linalg.inv(mat) @ center.T).T - \
         np.array([np.min(new_corners[:, 0]), np.min(new_corners[:, 1])])
     
     new_radius = height * np.sqrt(np.abs(ratio / np.linalg.det(mat))) # derivation: area of a circle / area of an ellipse
     if print_log:
-        basefich0 = options['basefich0']
-        print(
-            'unrotation angle theta = ' +
-            "{:.3f}".format(
-                math.degrees(theta)) +
-            " degrees")
-        np.set_printoptions(suppress=True)
-        logme(basefich0 + '_log.txt', options, 'Y/X ratio : ' + "{:.3f}".format(ratio))
-        print('Y/X ratio : ' + "{:.3f}".format(ratio))
-        logme(basefich0 + '_log.txt', options,
-            'Tilt angle : ' +
-            "{:.3f}".format(
-                math.degrees(phi)) +
-            " degrees")
-        logme(basefich0 + '_log.txt', options, 'Linear transform correction matrix : \n' + str(mat))
-        logme(basefich0 + '_log.txt', options, 'Disk position, radius : ' + ((str(new_center) + ', ' + "{:.3f}".format(new_radius)) if not height == -1.0 else 'UNKNOWN'))
-        logme(basefich0 + '_log.txt', options, 'Unrotation : '  +
-            "{:.3f}".format(
-                math.degrees(theta)) +
-            " degrees")
-        np.set_printoptions(suppress=False)
+        log_correction(options, phi, ratio, mat, theta, new_center, new_radius, height)
     return corrected_img, (new_center[0], new_center[1], new_radius), mat3
 
+def log_correction(options, phi, ratio, mat, theta, new_center, new_radius, height):
+    basefich0 = options['basefich0']
+    print(
+        'unrotation angle theta = ' +
+        "{:.3f}".format(
+            math.degrees(theta)) +
+        " degrees")
+    np.set_printoptions(suppress=True)
+    logme(basefich0 + '_log.txt', options, 'Y/X ratio : ' + "{:.3f}".format(ratio))
+    print('Y/X ratio : ' + "{:.3f}".format(ratio))
+    logme(basefich0 + '_log.txt', options,
+        'Tilt angle : ' +
+        "{:.3f}".format(
+            math.degrees(phi)) +
+        " degrees")
+    logme(basefich0 + '_log.txt', options, 'Linear transform correction matrix : \n' + str(mat))
+    logme(basefich0 + '_log.txt', options, 'Disk position, radius : ' + ((str(new_center) + ', ' + "{:.3f}".format(new_radius)) if not height == -1.0 else 'UNKNOWN'))
+    logme(basefich0 + '_log.txt', options, 'Unrotation : '  +
+        "{:.3f}".format(
+            math.degrees(theta)) +
+        " degrees")
+    np.set_printoptions(suppress=False)
+
+def correct_images(images, phi, ratio, options, print_log=False):
+    """correct the geometry of images of the same shape (shifts of a file) with one set of
+    correction maps, warped in parallel threads
+    IN : list of numpy arrays (uint16), float, float
+    OUT : numpy array (n_images, h, w) of the corrected images
+    """
+    mat, theta, mat3, new_corners, output_shape = correction_geometry(images[0].shape, phi, ratio)
+    if print_log:
+        log_correction(options, phi, ratio, mat, theta, None, -1.0, -1.0)
+    if not use_fast_warp(images[0].shape, output_shape, options):
+        return np.array([correct_image(image, phi, ratio, np.array([-1.0, -1.0]), -1.0, options)[0] for image in images])
+    maps = get_correction_maps(images[0].shape, mat3, output_shape)
+    cube = np.zeros((len(images),) + output_shape, dtype=np.uint16)
+    def warp(k):
+        cube[k] = warp_image(images[k], maps)
+    with ThreadPoolExecutor(max_workers=options['read_threads'] or os.cpu_count() or 1) as executor:
+        list(executor.map(warp, range(len(images))))
+    return cube
+
 
 def get_flood_image(image):
     """
@@ -235,6 +401,9 @@ def get_edge_list(image, sigma=2):
     low_threshold = np.median(cv2.blur(image, ksize=(5, 5))) / 10
     high_threshold = low_threshold * 1.5
     print('using thresholds:', low_threshold, high_threshold)
+    import skimage.feature
+    import scipy.ndimage
+    from scipy.spatial import ConvexHull
     image_flooded = get_flood_image(image)
     edges = skimage.feature.canny(
         image=image_flooded,
@@ -248,31 +417,29 @@ def get_edge_list(image, sigma=2):
     if nf == 0:
         # try again with less blur, hope it will work
         return get_edge_list(image, sigma=sigma - 0.5)
-    region_sizes = [-1] + [np.sum(labelled == i) for i in range(1, nf + 1)]
-    filt = np.zeros(edges.shape)
-    for label in sorted(region_sizes, reverse=True)[:min(nf, NUM_REG)]:
-        filt[labelled == region_sizes.index(label)] = 1
+    # size of every region in one pass, and lookup tables from label to kept / not kept
+    region_sizes = np.bincount(labelled.ravel(), minlength=nf + 1)
+    region_sizes[0] = -1 # background
+    biggest = np.zeros(nf + 1, dtype=bool)
+    biggest[np.argsort(-region_sizes, kind='stable')[:min(nf, NUM_REG)]] = True
+    filt = biggest[labelled]
 
     X = np.argwhere(filt)  # find the non-zero pixels
     Xc = X[ConvexHull(X).vertices] # convex hull
-    Xd = np.zeros(edges.shape)
-    Xd[Xc[:, 0], Xc[:, 1]] = 1
-    filt = np.zeros(edges.shape)
-    
-    for label in sorted(region_sizes, reverse=True)[:min(nf, NUM_REG)]:
-        if np.any(np.logical_and(labelled == region_sizes.index(label), Xd)):
-            filt[labelled == region_sizes.index(label)] = 1
-    
-        
+    # keep the biggest regions which have a vertex of the convex hull
+    on_hull = np.zeros(nf + 1, dtype=bool)
+    on_hull[labelled[Xc[:, 0], Xc[:, 1]]] = True
+    filt = biggest & on_hull
+    filt = filt[labelled]
+
     x_min, y_min, x_max, y_max = np.min(X[:, 0]), np.min(
         X[:, 1]), np.max(X[:, 0]), np.max(X[:, 1])
     dx = x_max - x_min
     dy = y_max - y_min
     crop = 0.017  # was : 0.015
 
-    mask = np.zeros(filt.shape)
-    mask[int(x_min + dx * crop):int(x_max - dx * crop), :] = 1
-    filt *= mask
+    filt[:int(x_min + dx * crop), :] = False
+    filt[int(x_max - dx * crop):, :] = False
     X = np.argwhere(filt)  # find the non-zero pixels again
 
     x_min, y_min, x_max, y_max = np.min(X[:, 0]), np.min(
@@ -285,17 +452,66 @@ def get_edge_list(image, sigma=2):
     return np.array([X, raw_X], dtype=object)
 
 
-def ellipse_to_circle(image, options, basefich):
-    """from an entire sun frame, compute ellipse fit and return a circularise picture and center coordinates
-    IN : numpy array, dictionnayr of options
-    OUt :numpy array, numpy array (2 elements)
+def refine_circle(image, geometry, options, tol=0.01):
+    """with a known ellipse geometry, correct the image and fit a circle to the edge of the disk
+    (ends of the rows of the thresholded disk): much cheaper than a full ellipse fit
+    IN : numpy array (16 bit), (Y/X ratio, tilt angle in degrees), dictionnary of options, relative rms tolerance
+    OUT : circularised picture, circle (centreX, centreY, radius), borders [minX, minY, maxX, maxY],
+    or None if the edge does not fit a circle within tol
+    """
+    ratio, slant = geometry
+    from skimage.transform import downscale_local_mean
+    fix_img = correct_image(image, math.radians(slant), ratio, np.array([-1.0, -1.0]), -1.0, options, print_log=True)[0]
+    factor = 4
+    mask = get_flood_image(downscale_local_mean(fix_img / 65536, (factor, factor))) > 0
+    rows = np.nonzero(np.any(mask, axis=1))[0]
+    if len(rows) < 10:
+        return None
+    crop = int(len(rows) * 0.017) + 1 # top and bottom of the disk are poorly defined
+    rows = rows[crop:-crop]
+    left = np.argmax(mask[rows], axis=1)
+    right = mask.shape[1] - 1 - np.argmax(mask[rows, ::-1], axis=1)
+    # left and right edge points, without the ones cut by the sides of the image
+    x = np.concatenate((left[left > 0], right[right < mask.shape[1] - 1])).astype('float') * factor
+    y = np.concatenate((rows[left > 0], rows[right < mask.shape[1] - 1])).astype('float') * factor
+    if len(x) < 10:
+        return None
+    # algebraic circle fit: x^2 + y^2 = a x + b y + c
+    a, b, c = np.linalg.lstsq(np.stack((x, y, np.ones_like(x)), axis=1), x**2 + y**2, rcond=None)[0]
+    cx, cy = float(a / 2), float(b / 2)
+    r = math.sqrt(c + cx**2 + cy**2)
+    rms = np.sqrt(np.mean((np.hypot(x - cx, y - cy) - r)**2)) / r
+    logme(options['basefich0'] + '_log.txt', options, 'Circle refinement relative rms : ' + "{:.4f}".format(rms))
+    if rms > tol:
+        return None
+    logme(options['basefich0'] + '_log.txt', options, 'Disk position, radius : ' + str((cx, cy, r)))
+    return fix_img, (cx, cy, r), [np.min(x), np.min(y), np.max(x), np.max(y)]
+
+
+def find_ellipse(image, options):
+    """ellipse fit of the disk with the engine of options['ellipse_engine']:
+    'canny' (edge detection, two step LsqEllipse fit) or 'radial' (threshold crossings, robust fit)
+    IN : numpy array (scaled to [0, 1]), dictionnary of options
+    OUT : center (y, x), height, phi, ratio, points used by the fit, ellipse_points, raw edge points
     """
-    image = image / 65536  # assume 16 bit
+    from skimage.transform import downscale_local_mean
     factor = 4
-    processed = get_edge_list(downscale_local_mean(
-        image, (factor, factor))) * factor  # down-scaled, then upscaled back
+    small = downscale_local_mean(image, (factor, factor))
+    if options['ellipse_engine'] == 'radial':
+        raw_X = get_limb_points(small) * factor # down-scaled, then upscaled back
+        return radial_fit(raw_X) + (raw_X,)
+    processed = get_edge_list(small) * factor  # down-scaled, then upscaled back
     X, raw_X = processed[0], processed[1]
-    center, height, phi, ratio, X_f, ellipse_points = two_step(X)
+    return two_step(X) + (raw_X,)
+
+
+def ellipse_to_circle(image, options, basefich, cache_as=None):
+    """from an entire sun frame, compute ellipse fit and return a circularise picture and center coordinates
+    IN : numpy array, dictionnayr of options, name of the figure data in the analysis cache (None to not cache it)
+    OUt :numpy array, numpy array (2 elements)
+    """
+    image = image / 65536  # assume 16 bit (float64: the detection and the fit need the precision)
+    center, height, phi, ratio, X_f, ellipse_points, raw_X = find_ellipse(image, options)
     center = np.array([center[1], center[0]])
 
     fix_img, new_circle, mat3 = correct_image(image, phi, ratio, center, height, options, print_log=True)
@@ -308,29 +524,7 @@ def ellipse_to_circle(image, options, basefich):
     borders = [np.min(X_f3_t[:, 0]), np.min(X_f3_t[:, 1]), np.max(X_f3_t[:, 0]), np.max(X_f3_t[:, 1])]
     print('sun borders found:' + str(borders))
     if (not options['clahe_only']):
-        fig = matplotlib.figure.Figure()
-        ax = [[fig.add_subplot(2, 2, 1), fig.add_subplot(2, 2, 2)], [fig.add_subplot(2, 2, 3), fig.add_subplot(2, 2, 4)]]
-        #fig, ax = plt.subplots(ncols=2, nrows=2)
-        fig.tight_layout()
-        ax[0][0].imshow(image, cmap=matplotlib.pyplot.cm.gray)
-        ax[0][0].set_title('uncorrected image', fontsize=11)
-        ax[0][0].set_aspect('equal')
-        ax[0][1].set_aspect('equal')
-        ax[0][1].imshow(image, cmap=matplotlib.pyplot.cm.gray)
-        ax[0][1].plot(raw_X[:, 1], raw_X[:, 0], 'ro', label='edge detection')
-        ax[0][1].legend(prop={'size': 6})
-        ax[1][1].set_aspect('equal')
-        ax[1][1].plot(X_f[:, 1], X_f[:, 0], 'ro', label='filtered edges')
-        ax[1][1].plot(ellipse_points[:, 1], ellipse_points[:, 0],
-                      color='b', label='ellipse fit')
-        ax[1][1].set_ylim([image.shape[0], 0])  # make y-axis upside-down
-        ax[1][1].legend(prop={'size': 6})
-        ax[1][0].set_aspect('equal')
-        ax[1][0].imshow(fix_img, cmap=matplotlib.pyplot.cm.gray)
-        ax[1][0].axhline(y=borders[1])
-        ax[1][0].axhline(y=borders[3])
-        ax[1][0].axvline(x=borders[0])
-        ax[1][0].axvline(x=borders[2])
-        ax[1][0].set_title('geometrically corrected image', fontsize=11)    
-        fig.savefig(output_path(basefich + '_ellipse_fit.png', options), dpi=300)
+        diagnostics.save(output_path(basefich + '_ellipse_fit.png', options), 'ellipse_fit', options, cache_as=cache_as,
+                         image=diagnostics.small_image(image), shape=image.shape, fix_img=diagnostics.small_image(fix_img), fix_shape=fix_img.shape,
+                         raw_X=diagnostics.few_points(raw_X), X_f=diagnostics.few_points(X_f), ellipse_points=ellipse_points, borders=borders)
     return fix_img, new_circle, ratio, phi, borders
@@ -0,0 +1,152 @@
+"""
+@author: Andrew Smith
+contributors: Valerie Desnoux, Matt Considine
+Version 6 August 2023
+
+--------------------------------------------------------------
+Writing of the output images and FITS files
+- files are written by background threads (options['output_threads'], 0 to write immediately)
+- at most options['output_queue'] files wait to be written, so images do not pile up in memory
+- flush() waits until everything is written: it is called at the end of each file
+- images: PNG with compression level options['png_compression'], or 16-bit TIFF (options['image_format'])
+- FITS: optionally tile-compressed (options['fits_compress'])
+- with options['shift_cube'] ('fits' or 'npy'), the FITS images of all the shifts of a file are the planes
+  of one cube, written as each shift is processed
+- the writer threads belong to one process: a forked worker process (options['file_workers']) starts
+  with no writer and creates its own
+--------------------------------------------------------------
+"""
+import os
+import threading
+import traceback
+import cv2
+import numpy as np
+from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor
+
+executor = None
+slots = None # free places in the queue of files to write
+pending = [] # (future, path) of the files not yet flushed
+cubes = {} # path: (memory map, offset of the stored values) of the cubes being written
+lock = threading.Lock()
+
+# in a forked child the threads of the executor do not exist: start again with no writer
+def reset_after_fork():
+    global executor, slots, pending, cubes, lock
+    executor, slots, pending, cubes, lock = None, None, [], {}, threading.Lock()
+
+if hasattr(os, 'register_at_fork'): # not on Windows, where worker processes are spawned
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+def submit(path, options, fn, *args, **kwargs):
+    global executor, slots
+    if not options['output_threads']:
+        fn(*args, **kwargs)
+        return
+    with lock:
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=options['output_threads'])
+            slots = threading.Semaphore(max(1, options['output_queue']))
+    slots.acquire() # wait while the queue is full
+    def job():
+        try:
+            fn(*args, **kwargs)
+        finally:
+            slots.release()
+    with lock:
+        pending.append((executor.submit(job), path))
+
+'''
+wait for all the files submitted so far to be written
+raise an Exception if any of them failed
+'''
+def flush():
+    global pending
+    with lock:
+        todo, pending = pending, []
+        done_cubes = list(cubes.values())
+        cubes.clear()
+    failed = []
+    for future, path in todo:
+        try:
+            future.result()
+        except Exception:
+            traceback.print_exc()
+            print('ERROR: failed to write file: ' + path)
+            failed.append(path)
+    for cube, _ in done_cubes:
+        cube.flush()
+    if failed:
+        raise Exception('error writing files: ' + ', '.join(failed))
+
+# path of an image output (given with the .png extension) in the selected format
+def image_path(path, options):
+    return os.path.splitext(path)[0] + '.tif' if options['image_format'] == 'tiff' else path
+
+def write_image(path, img, options):
+    path = image_path(path, options)
+    params = [] if options['image_format'] == 'tiff' else [cv2.IMWRITE_PNG_COMPRESSION, options['png_compression']]
+    def imwrite():
+        if not cv2.imwrite(path, img, params):
+            raise Exception('error writing image: ' + path)
+    submit(path, options, imwrite)
+
+def write_fits(path, data, header, options):
+    if options['fits_compress']:
+        hdu = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, header)])
+    else:
+        hdu = fits.PrimaryHDU(data, header=header)
+    submit(path, options, hdu.writeto, path, overwrite=True)
+
+'''
+create a cube of 16-bit images: npy file, or FITS file with a spectral axis (wavelength offset
+from the line, from the shifts and the dispersion in A/pixel)
+return the memory map of the cube and the offset of the stored values
+'''
+def create_cube(path, shape, shifts, header, options):
+    if options['shift_cube'] == 'npy':
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.uint16, shape=shape), 0
+    hdr = fits.Header([('SIMPLE', True), ('BITPIX', 16), ('NAXIS', 3), ('NAXIS1', shape[2]), ('NAXIS2', shape[1]), ('NAXIS3', shape[0])])
+    hdr.extend([card for card in header.cards if not card.keyword in hdr and not card.keyword in ('BZERO', 'BSCALE', 'EXTEND')])
+    hdr['BZERO'] = 32768 # unsigned 16-bit
+    hdr['BSCALE'] = 1
+    steps = set(np.diff(shifts))
+    if len(steps) <= 1: # WCS needs evenly spaced shifts
+        hdr['CTYPE3'] = 'WAVE'
+        hdr['CUNIT3'] = 'Angstrom'
+        hdr['CRPIX3'] = 1
+        hdr['CRVAL3'] = (shifts[0] * options['dispersion'], 'wavelength offset from the line')
+        hdr['CDELT3'] = (steps.pop() if steps else 1) * options['dispersion']
+    for k, shift in enumerate(shifts):
+        hdr[f'SHIFT{k + 1}'] = (shift, f'pixel shift of plane {k + 1}')
+    header_bytes = hdr.tostring().encode('ascii')
+    data_size = int(np.prod(shape)) * 2
+    with open(path, 'wb') as f:
+        f.write(header_bytes)
+        f.truncate(len(header_bytes) + -(-data_size // 2880) * 2880) # data padded to a multiple of 2880 bytes
+    return np.memmap(path, dtype='>i2', mode='r+', offset=len(header_bytes), shape=shape), 32768
+
+'''
+write the 16-bit image of one shift in the cube of all the requested shifts (planes in order of shift)
+cube_path: path of the cube without extension
+'''
+def write_shift(cube_path, shift, data, header, options):
+    shifts = sorted(set(options['shift_requested']))
+    path = cube_path + ('.npy' if options['shift_cube'] == 'npy' else '.fits')
+    with lock:
+        if not path in cubes:
+            cubes[path] = create_cube(path, (len(shifts),) + data.shape, shifts, header, options)
+        cube, offset = cubes[path]
+    if not cube.shape[1:] == data.shape:
+        raise Exception(f'error: image of shift {shift} does not fit in the cube {path}')
+    k = shifts.index(shift)
+    def write():
+        cube[k] = data.astype(np.int32) - offset
+    submit(path, options, write)
+
+# FITS image of one shift: in its own file (path) or in the cube of all shifts (cube_path, without extension)
+def write_shift_fits(path, cube_path, shift, data, header, options):
+    if options['shift_cube']:
+        write_shift(cube_path, shift, data, header, options)
+    else:
+        write_fits(path, data, header, options)
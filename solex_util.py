@@ -5,25 +5,20 @@ Version 6 August 2023
 
 """
 
+# slow imports (scipy.signal, tkinter, matplotlib) are done where they are needed, for a faster start
 import numpy as np
-import matplotlib.figure
-import matplotlib.pyplot as plt
 from astropy.io import fits
-from scipy.interpolate import interp1d
 import os
 #import time
-from scipy.signal import savgol_filter
 import cv2
 import sys
 import math
-from scipy.ndimage import gaussian_filter1d
 from numpy.polynomial.polynomial import polyval
 from video_reader import *
-import tkinter as tk
-import ctypes # Modification Jean-Francois: for reading the monitor size
-import cv2
-from scipy.optimize import curve_fit
+from output_writer import write_image, write_fits, write_shift_fits, image_path, flush
+import diagnostics
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 def clearlog(path, options):
     try:
@@ -56,6 +51,14 @@ def logme(path, options, s):
 if options['output_dir'] is empty, then output there
 else output same file name, but into directory in options
 '''
+# size of the screen, to display images
+def screen_size():
+    import tkinter as tk
+    screen = tk.Tk()
+    size = screen.winfo_screenwidth(), screen.winfo_screenheight()
+    screen.destroy()
+    return size
+
 def output_path(path, options):
     if options['output_dir'].strip() == '':
         return path
@@ -84,22 +87,86 @@ def reject_outliers(data, m = 2):
     s = d/mdev if mdev else np.zeros(len(d))
     return data[s<m]
 
+# median of the values of each row where mask is set
+def row_median(data, mask):
+    n = np.sum(mask, axis=1)
+    s = np.sort(np.where(mask, data, np.inf), axis=1) # masked values are sorted last
+    lo = np.take_along_axis(s, np.maximum((n - 1) // 2, 0)[:, np.newaxis], axis=1)[:, 0]
+    hi = np.take_along_axis(s, np.minimum(n // 2, s.shape[1] - 1)[:, np.newaxis], axis=1)[:, 0]
+    return np.where(n > 0, (lo + hi) / 2, np.nan)
+
+# mean of the values of each row where mask is set
+def row_mean(data, mask):
+    return np.sum(np.where(mask, data, 0), axis=1) / np.sum(mask, axis=1)
+
+# reject_outliers on each row of data (restricted to mask): return the mask of the values kept
+def reject_outliers_rows(data, mask, m = 2):
+    median_value = row_median(data, mask)
+    d = np.abs(data - median_value[:, np.newaxis])
+    mdev = row_median(d, mask)[:, np.newaxis]
+    s = np.where(mdev != 0, d / np.where(mdev != 0, mdev, 1), 0)
+    return mask & (s < m)
+
 #downscale an image
 def downscale(image, f):
     return cv2.resize(image, (0,0), fx=f, fy=f) 
 
+# return the (left) column of the spectral line in each row for a given shift
+def get_line_columns(fit, shift, iw):
+    ind_l = (np.asarray(fit)[:, 0] + np.ones(len(fit))*shift).astype(int)
+
+    # CLEAN if fitting goes too far
+    ind_l[ind_l < 0] = 0
+    ind_l[ind_l > iw - 2] = iw - 2
+    return ind_l
+
+# return the range of columns [lo, hi) needed to reconstruct all shifts
+def get_line_band(fit, shifts, iw):
+    lo = min(np.min(get_line_columns(fit, shift, iw)) for shift in shifts)
+    hi = max(np.max(get_line_columns(fit, shift, iw)) for shift in shifts) + 2
+    return lo, hi
+
+'''
+split the frames of a reader into contiguous shards and call func(start, stop) on each shard
+in a thread pool (numpy releases the GIL while gathering and reducing frames)
+return the list of results, one per shard
+'''
+def map_frame_shards(rdr, options, func):
+    n_threads = options['read_threads'] or os.cpu_count() or 1
+    n_shards = max(1, min(n_threads, rdr.FrameCount // rdr.buffer_size))
+    bounds = np.linspace(0, rdr.FrameCount, n_shards + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=n_shards) as executor:
+        results = list(executor.map(func, bounds[:-1], bounds[1:]))
+    rdr.FrameIndex = rdr.FrameCount - 1 # all frames have been read
+    return results
+
+# sample the line columns ind_l (n_shifts x ih) and their right neighbours in a block of frames
+# (N x ih x w, or N x w x ih for unrotated frames with flag_rotate), writing the blended
+# intensities times scale to out (n_shifts x ih x N)
+def reconstruct_frames(block, ind_l, left_weights, out, scale=1, flag_rotate=False):
+    if flag_rotate: # np.rot90(frame)[y, x] == frame[x, ih - 1 - y]
+        rows = block.shape[2] - 1 - np.arange(block.shape[2])
+        left_cols = block[:, ind_l, rows] # N x n_shifts x ih, one gather for all shifts
+        right_cols = block[:, ind_l + 1, rows]
+    else:
+        rows = np.arange(block.shape[1])
+        left_cols = block[:, rows, ind_l] # N x n_shifts x ih, one gather for all shifts
+        right_cols = block[:, rows, ind_l + 1]
+    intensity = left_cols * left_weights + right_cols * (1 - left_weights)
+    if scale != 1:
+        intensity *= scale # native bit depth to 16-bit
+    out[...] = np.transpose(intensity, (1, 2, 0))
+
 # read video and return constructed image of sun using fit
 def read_video_improved(rdr, fit, options):
     ih, iw = rdr.ih, rdr.iw
     FrameMax = rdr.FrameCount
-    disk_list = [np.zeros((ih, FrameMax), dtype='uint16')
-                 for _ in options['shift']]
+    disk_cube = np.zeros((len(options['shift']), ih, FrameMax), dtype='uint16')
+    disk_list = list(disk_cube) # one image per shift (views into disk_cube)
 
     if options['flag_display']:
-        screen = tk.Tk()
-        sw, sh = screen.winfo_screenwidth(), screen.winfo_screenheight()
+        sw, sh = screen_size()
         scaling = sh/ih * 0.8
-        screen.destroy()
         cv2.namedWindow('disk', cv2.WINDOW_NORMAL)
         cv2.resizeWindow('disk', int(FrameMax * scaling), int(ih * scaling))
         cv2.moveWindow('disk', 200, 0)
@@ -107,34 +174,28 @@ def read_video_improved(rdr, fit, options):
         cv2.moveWindow('image', 0, 0)
         cv2.resizeWindow('image', int(iw * scaling), int(ih * scaling))
 
-    col_indeces = []
-
-    for shift in options['shift']:
-        ind_l = (np.asarray(fit)[:, 0] + np.ones(ih)*shift).astype(int)
-
-        # CLEAN if fitting goes too far
-        ind_l[ind_l < 0] = 0
-        ind_l[ind_l > iw - 2] = iw - 2
-        ind_r = (ind_l + np.ones(ih)).astype(int)
-        col_indeces.append((ind_l, ind_r))
-
+    # frames may only hold a band of columns starting at rdr.col0
+    ind_l = np.array([get_line_columns(fit, shift, iw) for shift in options['shift']]) - rdr.col0
     left_weights = np.ones(ih) - np.asarray(fit)[:, 1]
-    right_weights = np.ones(ih) - left_weights
 
     # lance la reconstruction du disk a partir des trames
     #print('reader num frames:', rdr.FrameCount)
+    if rdr.random_access and not options['flag_display']:
+        # each shard fills its own range of columns of disk_cube
+        def reconstruct_shard(start, stop):
+            for b in range(start, stop, rdr.buffer_size):
+                block = rdr.get_frames(b, min(b + rdr.buffer_size, stop))
+                reconstruct_frames(block, ind_l, left_weights, disk_cube[:, :, b:b + block.shape[0]], rdr.scale, rdr.flag_rotate)
+        map_frame_shards(rdr, options, reconstruct_shard)
+
     while rdr.has_frames():
-        img = rdr.next_frame()
-        for i in range(len(options['shift'])):
-            ind_l, ind_r = col_indeces[i]
-            left_col = img[np.arange(ih), ind_l]
-            right_col = img[np.arange(ih), ind_r]
-            IntensiteRaie = left_col * left_weights + right_col * right_weights
-            disk_list[i][:, rdr.FrameIndex] = IntensiteRaie
-
-        if options['flag_display'] and rdr.FrameIndex % 10 == 0:
+        start = rdr.FrameIndex + 1
+        block = rdr.next_frames(rdr.buffer_size)
+        reconstruct_frames(block, ind_l, left_weights, disk_cube[:, :, start:start + block.shape[0]], rdr.scale, rdr.flag_rotate)
+
+        if options['flag_display']:
             # disk_list[1] is always shift = 0
-            cv2.imshow('image', img)
+            cv2.imshow('image', np.rot90(block[-1]) if rdr.flag_rotate else block[-1])
             cv2.imshow('disk', disk_list[1])
             if cv2.waitKey(
                     1) == 27:                     # exit if Escape is hit
@@ -157,6 +218,12 @@ def make_header(rdr):
     hdr['BIN1'] = 1
     hdr['BIN2'] = 1
     hdr['EXPTIME'] = 0
+    # frames and region of interest read from the video
+    hdr['FRSTART'] = rdr.frame_start
+    hdr['FRSTEP'] = rdr.frame_step
+    hdr['FRCOUNT'] = rdr.FrameCount
+    hdr['ROIROW0'] = rdr.row0
+    hdr['ROICOL0'] = rdr.col0
     return hdr
 
 # compute mean and max image of video
@@ -178,52 +245,114 @@ def compute_mean_max(rdr, options, basefich0):
     
     logme(basefich0 + '_log.txt', options, 'Width, Height : ' + str(rdr.Width) + ' ' + str(rdr.Height))
     logme(basefich0 + '_log.txt', options, 'Number of frames : ' + str(rdr.FrameCount))
-    my_data = np.zeros((rdr.ih, rdr.iw), dtype='uint64')
-    max_data = np.zeros((rdr.ih, rdr.iw), dtype='uint16')
-    while rdr.has_frames():
-        img = rdr.next_frame()
-        my_data += img
-        max_data = np.maximum(max_data, img)
-    return (my_data / rdr.FrameCount).astype('uint16'), max_data
-
-
-def compute_mean_return_fit(vid_rdr, options, hdr, iw, ih, basefich0):
+    my_data, max_data = sum_max_frames(rdr, options)
+    return mean_max_images(rdr, my_data, max_data, rdr.FrameCount)
+
+# sum and max of all the frames of a reader (unrotated, native bit depth)
+def sum_max_frames(rdr, options):
+    shape = (rdr.ncols, rdr.ih) if rdr.flag_rotate else (rdr.ih, rdr.ncols) # frames are not rotated
+    # partial sum and max of the frames [start, stop)
+    def mean_max_shard(start, stop):
+        my_data = np.zeros(shape, dtype='uint64')
+        max_data = np.zeros(shape, dtype=rdr.infiledatatype)
+        for b in range(start, stop, rdr.buffer_size):
+            block = rdr.get_frames(b, min(b + rdr.buffer_size, stop))
+            my_data += np.sum(block, axis=0, dtype='uint64')
+            max_data = np.maximum(max_data, np.max(block, axis=0))
+        return my_data, max_data
+
+    if rdr.random_access:
+        partials = map_frame_shards(rdr, options, mean_max_shard)
+        my_data = np.sum([x[0] for x in partials], axis=0, dtype='uint64')
+        max_data = np.max([x[1] for x in partials], axis=0)
+    else:
+        my_data = np.zeros(shape, dtype='uint64')
+        max_data = np.zeros(shape, dtype=rdr.infiledatatype)
+        while rdr.has_frames():
+            block = rdr.next_frames(rdr.buffer_size)
+            my_data += np.sum(block, axis=0, dtype='uint64')
+            max_data = np.maximum(max_data, np.max(block, axis=0))
+    return my_data, max_data
+
+# 16-bit mean and max images from the sum and max of n frames
+def mean_max_images(rdr, my_data, max_data, n):
+    if rdr.flag_rotate: # rotate only the results
+        my_data, max_data = np.ascontiguousarray(np.rot90(my_data)), np.ascontiguousarray(np.rot90(max_data))
+    # frames are summed in their native bit depth, the outputs are 16-bit
+    return (my_data * rdr.scale / n).astype('uint16'), max_data.astype('uint16') * rdr.scale
+
+def sample_mean_max(rdr, options, basefich0, tol=0.1):
     """
-    ----------------------------------------------------------------------------
-    Use the mean image to find the location of the spectral line of maximum darkness
-    Apply a 3rd order polynomial fit to the datapoints, and return the fit, as well as the
-    detected extent of the line in the y-direction.
-    ----------------------------------------------------------------------------
+    Mean and max images from a subset of the frames (SER only), for line detection.
+    Start with one frame in options['line_sampling'] and halve the stride, adding the frames
+    in between, until the line fit moves by less than tol pixels over the rows of the disk
+    (y1:y2, the fit is extrapolated outside); stride 1 is the full pass.
+    Return the mean and max images and the line fit (see fit_line).
+    """
+    step = 2 ** int(np.log2(options['line_sampling']))
+    sub = rdr.subsample(0, step)
+    my_data, max_data = sum_max_frames(sub, options)
+    n, line, prev_fit = sub.FrameCount, None, None
+    while True:
+        mean_img, max_img = mean_max_images(rdr, my_data, max_data, n)
+        try:
+            line = fit_line(mean_img, max_img)
+            fit = line[0]
+        except Exception:
+            if step == 1:
+                raise
+            fit = None # too few frames to find the line
+        if step == 1:
+            break
+        if fit is not None and prev_fit is not None:
+            rows = np.arange(line[1], line[2], dtype='d')
+            if len(rows) and np.max(np.abs(polyval(rows, fit) - polyval(rows, prev_fit))) < tol:
+                break
+        prev_fit = fit
+        step //= 2
+        sub = rdr.subsample(step, 2 * step) # the frames between the ones already summed
+        sub_data, sub_max = sum_max_frames(sub, options)
+        my_data += sub_data
+        max_data = np.maximum(max_data, sub_max)
+        n += sub.FrameCount
+    logme(basefich0 + '_log.txt', options, f'Line detection from {n} of {rdr.FrameCount} frames')
+    return mean_img, max_img, line
+
+
+def estimate_line_band(rdr, options, n_sample=25, margin=10):
+    """
+    Guess the columns around the spectral line from a few frames in the middle of the scan
+    (random access, SER only), wide enough for all the requested shifts.
+    Return (lo, hi), or None if the band would not be much narrower than the frame.
+    """
+    mid = rdr.FrameCount // 2
+    sample = rdr.get_frames(max(0, mid - n_sample // 2), min(rdr.FrameCount, mid + n_sample // 2 + 1))
+    mean_img = np.mean(sample, axis=0, dtype='float32')
+    max_img = np.max(sample, axis=0)
+    if rdr.flag_rotate:
+        mean_img, max_img = np.ascontiguousarray(np.rot90(mean_img)), np.ascontiguousarray(np.rot90(max_img))
+    y1, y2 = detect_bord(max_img, axis=1)
+    if y2 - y1 < 10:
+        return None
+    min_intensity = np.argmin(cv2.blur(mean_img, ksize=(5, 5)), axis=1)
+    p = np.polyfit(np.arange(y1, y2), min_intensity[y1:y2], 3)
+    curve = np.polyval(p, np.arange(rdr.ih)) + rdr.col0
+    lo = max(rdr.col0, int(np.min(curve)) + min(options['shift']) - margin)
+    hi = min(rdr.col0 + rdr.ncols, int(np.max(curve)) + max(options['shift']) + 2 + margin)
+    if hi <= lo or hi - lo > rdr.ncols // 2:
+        return None
+    return lo, hi
+
+def fit_line(mean_img, max_img):
+    """
+    Fit a 3rd order polynomial to the spectral line of maximum darkness in the mean image.
+    Return the polynomial p (increasing powers), the extent y1, y2 of the line in the y-direction,
+    the detected line positions and the mask of the positions used by the fit.
     """
-    flag_display = options['flag_display']
-    # first compute mean image
-    # rdr is the video_reader object
-    mean_img, max_img = compute_mean_max(vid_rdr, options, basefich0)
-    
-    if options['save_fit']:
-        DiskHDU = fits.PrimaryHDU(mean_img, header=hdr)
-        DiskHDU.writeto(output_path(basefich0 + '_mean.fits', options), overwrite='True')
-
-    # affiche image moyenne
-    if flag_display:
-        screen = tk.Tk()
-        sw, sh = screen.winfo_screenwidth(), screen.winfo_screenheight()
-        scaling = sh/ih * 0.8
-        screen.destroy()
-        cv2.namedWindow('Ser mean', cv2.WINDOW_NORMAL)
-        cv2.resizeWindow('Ser mean', int(iw*scaling), int(ih*scaling))
-        cv2.moveWindow('Ser mean', 100, 0)
-        cv2.imshow('Ser mean', mean_img)
-        if cv2.waitKey(2000) == 27:                     # exit if Escape is hit
-            cv2.destroyAllWindows()
-            sys.exit()
-
-        cv2.destroyAllWindows()
     y1, y2 = detect_bord(max_img, axis=1) # use maximum image to detect borders
     clip = int((y2 - y1) * 0.05)
     y1 = min(max_img.shape[0]-1, y1+clip)
     y2 = max(0, y2-clip)
-    logme(basefich0 + '_log.txt', options, 'Vertical limits y1, y2 : ' + str(y1) + ' ' + str(y2))
     blur_width_x = 25
     blur_width_y = int((y2 - y1) * 0.01)
     blur = cv2.blur(mean_img, ksize=(blur_width_x,blur_width_y))
@@ -252,24 +381,55 @@ def compute_mean_return_fit(vid_rdr, options, hdr, iw, ih, basefich0):
     tol_line_fit = 5
     mask_good = np.abs(delta_sharp - shift) < tol_line_fit
     p = np.flip(np.asarray(np.polyfit(np.arange(y1, y2)[mask_good], min_intensity_sharp[y1:y2][mask_good], 3), dtype='d'))
+    return p, y1, y2, min_intensity_sharp, mask_good
+
+def compute_mean_return_fit(vid_rdr, options, hdr, iw, ih, basefich0):
+    """
+    ----------------------------------------------------------------------------
+    Use the mean image to find the location of the spectral line of maximum darkness
+    Apply a 3rd order polynomial fit to the datapoints, and return the fit, as well as the
+    detected extent of the line in the y-direction.
+    ----------------------------------------------------------------------------
+    """
+    flag_display = options['flag_display']
+    # first compute mean image
+    # rdr is the video_reader object
+    if options['line_sampling'] and getattr(vid_rdr, 'SER_flag', False):
+        mean_img, max_img, line = sample_mean_max(vid_rdr, options, basefich0)
+    else:
+        mean_img, max_img = compute_mean_max(vid_rdr, options, basefich0)
+        line = None
+    
+    if options['save_fit']:
+        write_fits(output_path(basefich0 + '_mean.fits', options), mean_img, hdr, options)
+
+    # affiche image moyenne
+    if flag_display:
+        sw, sh = screen_size()
+        scaling = sh/ih * 0.8
+        cv2.namedWindow('Ser mean', cv2.WINDOW_NORMAL)
+        cv2.resizeWindow('Ser mean', int(iw*scaling), int(ih*scaling))
+        cv2.moveWindow('Ser mean', 100, 0)
+        cv2.imshow('Ser mean', mean_img)
+        if cv2.waitKey(2000) == 27:                     # exit if Escape is hit
+            cv2.destroyAllWindows()
+            sys.exit()
+
+        cv2.destroyAllWindows()
+    p, y1, y2, min_intensity_sharp, mask_good = line or fit_line(mean_img, max_img)
+    logme(basefich0 + '_log.txt', options, 'Vertical limits y1, y2 : ' + str(y1) + ' ' + str(y2))
     logme(basefich0 + '_log.txt', options, 'Spectral line polynomial fit: ' + str(p))
     
-    curve = polyval(np.asarray(np.arange(ih), dtype='d'), p)
+    curve = polyval(np.asarray(np.arange(ih), dtype='d'), p) + vid_rdr.col0 # columns of the full frame
     fit = [[math.floor(curve[y]), curve[y] - math.floor(curve[y]), y] for y in range(ih)]
 
     
     
     if not options['clahe_only']:
-        fig = matplotlib.figure.Figure()
-        ax = fig.add_subplot(1, 1, 1)
-        ax.imshow(mean_img, cmap=matplotlib.pyplot.cm.gray)
         s = (y2-y1)//20 + 1
-        ax.plot(min_intensity_sharp[y1:y2][mask_good][::s], np.arange(y1, y2)[mask_good][::s], 'rx', label='line detection')
-        ax.plot(curve, np.arange(ih), label='polynomial fit')
-        ax.legend(loc='center left', bbox_to_anchor=(1, 0.5))
-        ax.set_aspect(0.1)
-        fig.tight_layout()
-        fig.savefig(output_path(basefich0+'_spectral_line_data.png', options), dpi=400)
+        diagnostics.save(output_path(basefich0+'_spectral_line_data.png', options), 'spectral_line', options, cache_as='spectral_line',
+                         image=diagnostics.small_image(mean_img), shape=mean_img.shape, curve=curve - vid_rdr.col0,
+                         x=min_intensity_sharp[y1:y2][mask_good][::s], y=np.arange(y1, y2)[mask_good][::s])
     return mean_img, fit, y1, y2
 
 
@@ -279,23 +439,22 @@ borders: [minX, minY, maxX, maxY]
 circle: (centreX, centreY, radius)
 reqFlag: 0 if this was a user-requested image, else: 1 if shift = 10, 2 if shift = 0 (non-user requested)
 '''
-def correct_transversalium2(img, circle, borders, options, reqFlag, basefich):
+# correction factor of each row of the image
+def transversalium_correction(img, circle, borders, options):
     y1 = math.ceil(max(circle[1] - circle[2], borders[1]))
     y2 = math.floor(min(circle[1] + circle[2], borders[3]))
-    y_ratios_r = [0]
-    y_ratios = [0]
-    for y in range(y1 + 1, y2):
-        dx = math.floor((circle[2]**2 - (y-circle[1])**2)**0.5)
-        strip0 = img[y - 1, math.ceil(max(circle[0] - dx, borders[0])) : math.floor(min(circle[0] + dx, borders[2]))]
-        strip1 = img[y, math.ceil(max(circle[0] - dx, borders[0])) : math.floor(min(circle[0] + dx, borders[2]))]
-        
-        rat = np.log(strip1 / strip0)
-        y_ratios.append(np.mean(rat))
-        y_ratios_r.append(np.mean(reject_outliers(rat)))
-        if y % 100 == 0 and 0:
-            print(y)
-            plt.hist(rat, bins = np.linspace(0.5, 2, 128))
-            plt.savefig()
+    # chord of the disk in each row y1 + 1 ... y2 - 1, all rows at once
+    rows = np.arange(y1 + 1, y2)
+    dx = np.floor(np.sqrt(circle[2]**2 - (rows - circle[1])**2))
+    lo = np.clip(np.ceil(np.maximum(circle[0] - dx, borders[0])), 0, img.shape[1]).astype(int)
+    hi = np.clip(np.floor(np.minimum(circle[0] + dx, borders[2])), 0, img.shape[1]).astype(int)
+    c0, c1 = (np.min(lo), np.max(hi)) if len(rows) else (0, 0)
+    block = img[y1:y2, c0:c1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rat = np.log(block[1:] / block[:-1]) # log ratio of each row to the previous one
+        inside = (np.arange(c0, c1) >= lo[:, np.newaxis]) & (np.arange(c0, c1) < hi[:, np.newaxis])
+        y_ratios_r = [0] + list(row_mean(rat, reject_outliers_rows(rat, inside)))
+    from scipy.signal import savgol_filter
     trend = savgol_filter(y_ratios_r, min(options['trans_strength'], len(y_ratios_r) // 2 * 2 - 1), 3)
 
     detrended = y_ratios_r - trend # remove trend (smoothed)
@@ -315,17 +474,9 @@ def correct_transversalium2(img, circle, borders, options, reqFlag, basefich):
     N = correction.shape[0]
 
     # Tukey taper function
-    def t(x):
-        if 0 <= x < a*N/2:
-            return 1/2 * (1-math.cos(2*math.pi*x/(a*N)))
-        elif a*N/2 <= x <= N/2:
-            return 1
-        elif N/2 <= x <= N:
-            return t(N - x)
-        print('error: weird input for taper function: ' + str(x))
-        return 1
-
-    taper = np.array([t(x) for x in range(N)])
+    x = np.arange(N)
+    x = np.where(x <= N/2, x, N - x) # symmetric
+    taper = np.where(x < a*N/2, 1/2 * (1-np.cos(2*np.pi*x/(a*N))), 1)
     
     correction_t = np.ones(N) + (correction - np.ones(N)) * taper
 
@@ -336,74 +487,103 @@ def correct_transversalium2(img, circle, borders, options, reqFlag, basefich):
     c = np.ones(img.shape[0])
     c[y1:y2] = correction_t
     #c[c<1] = 1
+    return c
+
+# correction: correction factors of each row, computed from the image if None
+def correct_transversalium2(img, circle, borders, options, reqFlag, basefich, correction=None):
+    if correction is not None: # correction factors of a previous run
+        c = np.asarray(correction)
+    else:
+        c = transversalium_correction(img, circle, borders, options)
     options['_transversalium_cache'] = c
     if (not reqFlag) and (not options['clahe_only']):
-        fig = matplotlib.figure.Figure()
-        ax = fig.add_subplot(1, 1, 1)
-        ax.plot(c)
-        ax.set_xlabel('y')
-        ax.set_ylabel('transversalium correction factor')
-        fig.savefig(output_path(basefich+'_transversalium_correction.png', options), dpi=300)
-    ret = (img.T * c).T # multiply each row in image by correction factor
-    ret[ret > 65535] = 65535 # prevent overflow
-    return np.array(ret, dtype='uint16')
+        diagnostics.save(output_path(basefich+'_transversalium_correction.png', options), 'transversalium', options, correction=c)
+    dtype = work_dtype(options)
+    return img.astype(dtype) * c.astype(dtype)[:, np.newaxis] # multiply each row in image by correction factor (clipped at output)
 
+# dtype of the transversalium correction and of the skimage warp (fast_warp off): the ellipse fit and
+# the brightness rescaling always run in float64
+def work_dtype(options):
+    return np.dtype(options['work_dtype'])
+
+def to_uint16(img):
+    if img.dtype == np.uint16:
+        return img
+    return np.clip(img, 0, 65535).astype(np.uint16) # prevent overflow
 
 def rescale_brightness(img, lo, hi, alpha=1.0):
     sat = np.iinfo(img.dtype).max
     assert(sat >= hi > lo)
-    rescaled = (float(sat) * alpha * (img - lo) / (hi - lo)) # convert to float to prevent integer multiplication
-    rescaled[rescaled<0] = 0
-    rescaled[rescaled>sat] = sat
+    rescaled = img.astype('float64') # convert to float to prevent integer multiplication
+    rescaled -= lo
+    rescaled *= float(sat) * alpha
+    rescaled /= hi - lo
+    np.clip(rescaled, 0, sat, out=rescaled)
     return rescaled.astype(img.dtype)
 
+# rescale_brightness of every 16-bit value: images are stretched with lut[img]
+# (only 65536 values: always computed in float64)
+def rescale_lut(lo, hi, alpha=1.0):
+    return rescale_brightness(np.arange(65536, dtype=np.uint16), lo, hi, alpha)
+
+'''
+percentiles of a 16-bit image from its histogram (one pass, no sort)
+same values as np.percentile (linear interpolation)
+'''
+def histogram_percentiles(img, qs):
+    cdf = np.cumsum(np.bincount(img.ravel(), minlength=65536))
+    pos = np.asarray(qs, dtype='d') / 100 * (cdf[-1] - 1)
+    t = pos - np.floor(pos)
+    a = np.searchsorted(cdf, np.floor(pos), side='right') # sorted values at the indices around pos
+    b = np.searchsorted(cdf, np.ceil(pos), side='right')
+    return np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+
+# position of pixel (x, y) of an image of this shape after np.rot90(img, k)
+def rotate_point(x, y, k, shape):
+    h, w = shape
+    for _ in range(k % 4):
+        x, y, h, w = y, w - 1 - x, w, h
+    return x, y
+
 def image_process(frame, cercle, options, header, basefich):
-    frame=frame.astype(np.uint16) # make sure we are working with uint16 data
+    frame=to_uint16(frame) # make sure we are working with uint16 data
     flag_result_show = options['flag_display']
     # create a CLAHE object (Arguments are optional)
     # clahe = cv2.createCLAHE(clipLimit=0.8, tileGridSize=(5,5))
     clahe = cv2.createCLAHE(clipLimit=0.8, tileGridSize=(2,2))
     cl1 = clahe.apply(frame)
     
-    bright = np.percentile(frame, 99.9999) # basically the same as max
-    dark_clahe=np.percentile(cl1, 10)
-    bright_clahe=np.max(cl1)
-    frame_raw    = frame # no rescale
-    frame_HC     = rescale_brightness(frame, bright*0.25, bright)             
-    frame_protus = rescale_brightness(frame, 0, bright*0.18)
-    cc = rescale_brightness(cl1, dark_clahe, bright_clahe)
+    bright, = histogram_percentiles(frame, [99.9999]) # basically the same as max
+    dark_clahe, bright_clahe = histogram_percentiles(cl1, [10, 100])
+
+    # handle rotations: rotate once, the stretched images are then made with look-up tables
+    k = options['img_rotate']//90
+    frame_raw    = np.ascontiguousarray(np.rot90(frame, k, axes=(0,1))) # no rescale
+    frame_HC     = rescale_lut(bright*0.25, bright)[frame_raw]
+    frame_protus = rescale_lut(0, bright*0.18)[frame_raw]
+    cc = rescale_lut(dark_clahe, bright_clahe)[np.ascontiguousarray(np.rot90(cl1, k, axes=(0,1)))]
     if not cercle == (-1, -1, -1) and options['disk_display']:
-        x0=int(cercle[0])
-        y0=int(cercle[1])
+        x0, y0 = rotate_point(int(cercle[0]), int(cercle[1]), k, frame.shape)
         r=int(cercle[2]) + options['delta_radius']
         if r > 0:
             frame_protus = cv2.circle(frame_protus, (x0,y0),r,80,-1)
-    
-    # handle rotations
-    frame_raw = np.rot90(frame_raw, options['img_rotate']//90, axes=(0,1))
-    frame_HC = np.rot90(frame_HC, options['img_rotate']//90, axes=(0,1))
-    frame_protus = np.rot90(frame_protus, options['img_rotate']//90, axes=(0,1))
-    cc = np.rot90(cc, options['img_rotate']//90, axes=(0,1))
-
-    # save the clahe as a png
-    compression = 0
+
+    # save the clahe as a png (or tiff, see output_writer)
     if not '_nolog' in options: # '_nolog' is used in spectralAnalyser
-        print('saving image to:' + basefich+'_clahe.png')
-        cv2.imwrite(output_path(basefich+'_clahe.png', options),cc, [cv2.IMWRITE_PNG_COMPRESSION, compression])   # Modification Jean-Francois: placed before the IF for clear reading
+        print('saving image to:' + image_path(basefich+'_clahe.png', options))
+        write_image(output_path(basefich+'_clahe.png', options), cc, options)   # Modification Jean-Francois: placed before the IF for clear reading
     if not options['clahe_only']:
         # save "high-contrast" and "protus" pngs
-        cv2.imwrite(output_path(basefich+'_uncontrasted.png', options), frame_raw, [cv2.IMWRITE_PNG_COMPRESSION, compression])
-        cv2.imwrite(output_path(basefich+'_high_contrast.png', options), frame_HC, [cv2.IMWRITE_PNG_COMPRESSION, compression])
-        cv2.imwrite(output_path(basefich+'_protus.png', options), frame_protus, [cv2.IMWRITE_PNG_COMPRESSION, compression])
+        write_image(output_path(basefich+'_uncontrasted.png', options), frame_raw, options)
+        write_image(output_path(basefich+'_high_contrast.png', options), frame_HC, options)
+        write_image(output_path(basefich+'_protus.png', options), frame_protus, options)
     
     # The 3 images are concatenated together in 1 image => 'Sun images'
     # The 'Sun images' is scaled for the monitor maximal dimension ... it is scaled to match the dimension of the monitor without 
     # changing the Y/X scale of the images 
     if flag_result_show:
         im_3 = cv2.hconcat([cc, frame_HC, frame_protus])
-        screen = tk.Tk()
-        screensize = screen.winfo_screenwidth(), screen.winfo_screenheight()
-        screen.destroy()
+        screensize = screen_size()
         scale = min(screensize[0] / im_3.shape[1], screensize[1] / im_3.shape[0]) * 0.9
         cv2.namedWindow('Sun images', cv2.WINDOW_NORMAL)
         cv2.moveWindow('Sun images', 0, 0)
@@ -414,6 +594,5 @@ def image_process(frame, cercle, options, header, basefich):
     
     if options['save_fit']:
         # save the fits file
-        DiskHDU=fits.PrimaryHDU(cl1,header)
-        DiskHDU.writeto(output_path(basefich+ '_clahe.fits', options), overwrite='True')
+        write_fits(output_path(basefich+ '_clahe.fits', options), cl1, header, options)
     return (cc, frame_protus)
@@ -0,0 +1,40 @@
+"""
+Ellipse fits of the 'radial' engine, checked against the fits of the ellipse package (LsqEllipse)
+
+usage: python -m pytest tests
+"""
+import os
+import sys
+import math
+import numpy as np
+from ellipse import LsqEllipse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ellipse_to_circle import conic_parameters, robust_ellipse_fit, normalise_axes
+
+
+# points on an ellipse of centre (y, x), semi-axes width, height and tilt phi, in (y, x) coordinates
+def ellipse_points(center, width, height, phi, n=400, noise=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 2 * math.pi, n, endpoint=False)
+    u, v = width * np.cos(t), height * np.sin(t)
+    y = center[0] + u * math.cos(phi) - v * math.sin(phi)
+    x = center[1] + u * math.sin(phi) + v * math.cos(phi)
+    return np.stack([y, x], axis=1) + rng.normal(0, noise, (n, 2))
+
+def test_conic_parameters_as_lsq_ellipse():
+    for phi in (0.3, -0.3, 1.2, -1.2):
+        reg = LsqEllipse().fit(ellipse_points((400, 300), 250, 220, phi, noise=0.5))
+        expected = reg.as_parameters()
+        result = conic_parameters(np.ravel(reg.coefficients))
+        np.testing.assert_allclose(result[0], expected[0], rtol=1e-9)
+        np.testing.assert_allclose(result[1:], expected[1:], rtol=1e-9)
+
+def test_robust_fit_as_lsq_ellipse():
+    points = ellipse_points((400, 300), 250, 220, 0.3, noise=0.5)
+    center, width, height, phi = LsqEllipse().fit(points).as_parameters()
+    outliers = np.array([[100.0, 100.0], [700.0, 550.0], [420.0, 310.0]])
+    result = robust_ellipse_fit(np.concatenate((points, outliers)))
+    np.testing.assert_allclose(result[0], center, atol=0.1)
+    np.testing.assert_allclose(normalise_axes(*result[1:4]), normalise_axes(width, height, phi), atol=0.1) # same axes, maybe swapped
+    assert not np.any(result[4][-3:]) # the outliers are rejected
@@ -0,0 +1,61 @@
+"""
+Reading of SER captures that are still being written: the header frame count is 0 until the
+capture software closes the file, frames are appended as they arrive
+
+usage: python -m pytest tests
+"""
+import os
+import sys
+import copy
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import SHG_MAIN
+from Solex_recon import solex_stream
+from solex_util import sample_mean_max
+from video_reader import video_reader
+
+
+# scan of a limb-darkened disk through a spectral line (16-bit frames of h rows, w columns)
+def synthetic_scan(n=200, h=240, w=60, r=80):
+    rng = np.random.default_rng(0)
+    y = np.arange(h)[:, None]
+    x = np.arange(w)[None, :]
+    line = 30 + 0.0002 * (y - h / 2)**2
+    spectrum = 1 - 0.7 * np.exp(-((x - line) / 2.5)**2)
+    frames = np.empty((n, h, w), dtype='uint16')
+    for i in range(n):
+        rho2 = ((y[:, 0] - h / 2)**2 + ((i - n / 2) * 1.1)**2) / r**2
+        profile = np.where(rho2 < 1, 0.4 + 0.6 * np.sqrt(np.clip(1 - rho2, 0, 1))**0.5, 0.1)[:, None]
+        frames[i] = np.clip(40000 * profile * spectrum + rng.normal(0, 200, (h, w)), 0, 65535)
+    return frames
+
+# SER file with the frame count of the header (0 while the capture is running)
+def write_ser(path, frames, header_count):
+    n, h, w = frames.shape
+    header = bytearray(178)
+    header[:14] = b'LUCAM-RECORDER'
+    header[14:42] = np.array([0, 0, 0, w, h, 16, header_count], dtype='<u4').tobytes()
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(frames.astype('<u2').tobytes())
+
+def test_stream_with_line_sampling(tmp_path):
+    path = str(tmp_path / 'live.ser')
+    write_ser(path, synthetic_scan(), 0)
+    options = copy.deepcopy(SHG_MAIN.options)
+    options.update({'shift': [0], 'line_sampling': 8, 'stream_timeout': 0.5})
+    previews = []
+    preview = solex_stream(path, options, previews.append, poll=0.1)
+    assert previews and os.path.exists(preview)
+
+def test_sampling_of_refreshed_capture(tmp_path):
+    path = str(tmp_path / 'live.ser')
+    write_ser(path, synthetic_scan(), 0)
+    rdr = video_reader(path)
+    assert not rdr.refresh() # capture not complete: all frames on disk are read
+    assert rdr.subsample(1, 4).FrameCount == len(range(1, rdr.FrameCount, 4))
+    options = copy.deepcopy(SHG_MAIN.options)
+    options.update({'line_sampling': 8, '_nolog': True})
+    _, _, line = sample_mean_max(rdr, options, str(tmp_path / 'live'))
+    assert line[2] > line[1]
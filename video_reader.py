@@ -6,14 +6,24 @@ Version 24 July 2023
 """
 import numpy as np
 import cv2 #MattC
+import os
+import queue
+import threading
 
 class video_reader:
 
-    def __init__(self, file, buffer_size = 25):
+    '''
+    frame_range: (start, stop, step) to read only some of the frames (stop may be None)
+    roi_rows, roi_cols: (lo, hi) to read only some rows / columns of the (rotated) image
+    the image processed is the ROI rows (ih of them), while columns keep the coordinates of
+    the full frame: frames hold ncols columns starting at col0, out of iw
+    '''
+    def __init__(self, file, buffer_size = 25, single_channel = False, frame_range = None, roi_rows = None, roi_cols = None, byteswap = False):
         # ouverture et lecture de l'entete du fichier ser
         self.file = file
         self.buffer_size = buffer_size
-        self.buffer_remaining = 0
+        self.single_channel = single_channel # AVI: use the green channel instead of a grayscale conversion
+        self.byteswap = byteswap # SER: read 16-bit data as big-endian when the header says so
         
         if self.file.upper().endswith('.SER'): #MattC 20210726
             self.SER_flag=True
@@ -64,6 +74,15 @@ class video_reader:
             self.FrameIndex=-1             # Index de trame, on evite les deux premieres
             self.offset=178               # Offset de l'entete fichier ser
             self.fileoffset=178 #MattC to avoid stomping on offset accumulator
+
+            # the SER spec says littleEndian=1 means little-endian data, but most capture software writes 0 for
+            # little-endian data: 16-bit data is only byte swapped on request
+            self.big_endian_flag = bool(self.littleEndian[0]) and self.infilebytes > 1
+            self.dtype = np.dtype(self.infiledatatype).newbyteorder('>' if self.big_endian_flag and self.byteswap else '<')
+            # do not trust FrameCount beyond the end of the file (truncated captures)
+            self.frames_in_file = min(self.FrameCount, self.frames_available())
+            self.map_frames()
+            self.random_access = True
             
         elif self.AVI_flag: #MattC 
     	    #deal with avi file
@@ -73,14 +92,19 @@ class video_reader:
             self.Height = int(self.file.get(cv2.CAP_PROP_FRAME_HEIGHT))
             self.PixelDepthPerPlane=1*8
             self.FrameCount = int(self.file.get(cv2.CAP_PROP_FRAME_COUNT))            
+            self.frames_in_file = self.FrameCount
             self.count=self.Width*self.Height
             self.infilebytes=1            
             self.FrameIndex=-1
             self.offset = 0
             self.fileoffset = 0 #MattC to avoid stomping on offset accumulator
+            self.random_access = False # frames are decoded in order
+            self.decoder = None # background decoding thread, started on first read
         else: #MattC
     	    ok_flag = False
 
+        # frames are served as stored: when flag_rotate is set, the image to process is np.rot90(frame),
+        # so consumers swap axes when indexing instead of rotating every frame
         if self.Width > self.Height:
             self.flag_rotate = True
             self.ih = self.Width
@@ -89,46 +113,144 @@ class video_reader:
             self.flag_rotate = False
             self.iw = self.Width
             self.ih = self.Height
+        # region of interest, in the rows and columns of the (rotated) image
+        self.row0, row_hi = roi_rows if roi_rows else (0, self.ih)
+        self.col0, col_hi = roi_cols if roi_cols else (0, self.iw)
+        self.ih = row_hi - self.row0
+        self.ncols = col_hi - self.col0
+        if self.flag_rotate: # rotated columns are the rows of the frames, rotated rows are reversed frame columns
+            self.frame_roi = (slice(self.col0, col_hi), slice(self.Width - row_hi, self.Width - self.row0))
+            self.frame_shape = (self.ncols, self.ih)
+        else:
+            self.frame_roi = (slice(self.row0, row_hi), slice(self.col0, col_hi))
+            self.frame_shape = (self.ih, self.ncols)
+        self.frame_start, self.frame_stop, self.frame_step = frame_range if frame_range else (0, None, 1)
+        self.select_frames()
+        # frames are returned in their native bit depth: multiply by scale for 16-bit values
+        self.scale = 256 if self.infiledatatype == 'uint8' else 1
         #print(f'in video reader with nframes, height, width = {self.FrameCount}, {self.ih}, {self.iw}')
 
-    def next_frame(self):
-        self.FrameIndex += 1
-        self.offset = self.fileoffset + self.FrameIndex * self.count * self.infilebytes #MattC track offset
-      
-        if self.SER_flag: #MattC
-            if self.buffer_remaining == 0:
-                self.buf = np.fromfile(
-                    self.file,
-                    dtype = self.infiledatatype,
-                    count = self.count * max(0, min(self.buffer_size, self.FrameCount - self.FrameIndex)),
-                    offset=self.offset)
-                self.buffer_remaining = self.buffer_size
-            i = self.buffer_size - self.buffer_remaining
-            img = self.buf[self.count*i : self.count*(i+1)]
-            self.buffer_remaining -= 1
+    # number of frames in the frame range
+    def select_frames(self):
+        stop = self.frames_in_file if self.frame_stop is None else min(self.frame_stop, self.frames_in_file)
+        self.FrameCount = len(range(self.frame_start, stop, self.frame_step))
 
-            
+    # reader over every step-th frame of the frame range starting at offset, with the same region of interest
+    # and the same frames on disk (the count of a capture followed with refresh, not the header count)
+    def subsample(self, offset, step):
+        sub = video_reader(self.file, self.buffer_size, self.single_channel,
+                           frame_range=(self.frame_start + offset * self.frame_step, self.frame_stop, self.frame_step * step),
+                           roi_rows=(self.row0, self.row0 + self.ih), roi_cols=(self.col0, self.col0 + self.ncols), byteswap=self.byteswap)
+        if self.SER_flag:
+            sub.frames_in_file, sub.mmap = self.frames_in_file, self.mmap
+            sub.select_frames()
+        return sub
+
+    def frames_available(self):
+        return (os.path.getsize(self.file) - self.fileoffset) // (self.count * self.infilebytes)
+
+    def map_frames(self):
+        # one memory map over the whole frame block: frames are served as views, not copies
+        self.mmap = np.memmap(self.file, dtype=self.dtype, mode='r', offset=self.fileoffset,
+                              shape=(self.frames_in_file, self.Height, self.Width)) if self.frames_in_file > 0 else None
+
+    def refresh(self):
+        '''
+        tail a SER file that is still being written: re-read the header frame count and the file size,
+        and extend FrameCount and the memory map to the frames now on disk
+        return True if the capture is complete (the final frame count is in the header and all frames are on disk)
+        '''
+        header_count = np.fromfile(self.file, dtype='uint32', count=1, offset=38)[0]
+        n_available = self.frames_available()
+        self.frames_in_file = min(header_count, n_available) if header_count > 0 else n_available
+        self.map_frames()
+        self.select_frames()
+        return 0 < header_count <= n_available
+
+    def get_frames(self, start, stop):
+        '''
+        return frames [start, stop) of the frame range of a SER file as a (n, frame_shape) view of the
+        memory map (no copy, native bit depth, region of interest, not rotated: see flag_rotate)
+        does not change the frame index, so it can be called from several threads
+        '''
+        if not self.SER_flag:
+            raise Exception('error random frame access is only available for SER files')
+        first = self.frame_start + start * self.frame_step
+        return self.mmap[first:first + (stop - start) * self.frame_step:self.frame_step, self.frame_roi[0], self.frame_roi[1]]
+
+    def next_frames(self, n):
+        '''
+        return up to n next frames as a (k, frame_shape) array and advance the frame index by k
+        '''
+        start = self.FrameIndex + 1
+        stop = min(start + n, self.FrameCount)
+        if self.SER_flag:
+            block = self.get_frames(start, stop)
         elif self.AVI_flag:
-            ret, img = self.file.read()
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+            if self.decoder is None:
+                self.start_decoder()
+            block = np.zeros((stop - start,) + self.frame_shape, dtype=self.infiledatatype)
+            for i in range(stop - start):
+                img = self.frame_queue.get()
+                if img is None:
+                    raise Exception('error AVI file ended after ' + str(start + i) + ' frames instead of ' + str(self.FrameCount))
+                block[i] = img
         else:
             raise Exception('error input file is neither is SER nor AVI')
+        self.FrameIndex = stop - 1
+        return block
 
-        img = np.reshape(img, (self.Height, self.Width))
-        
-        if self.flag_rotate:
-            img = np.rot90(img)
-        if self.infiledatatype == 'uint8':
-            img = np.asarray(img, dtype='uint16')*256 #upscale 8-bit to 16-bit
-        return img
+    def next_frame(self):
+        return self.next_frames(1)[0]
 
     def has_frames(self):
         return self.FrameIndex + 1 < self.FrameCount
 
+    def reset(self):
+        self.FrameIndex = -1
+        if self.AVI_flag:
+            self.stop_decoder()
+
+    # AVI: decode and convert frames to grayscale on a background thread,
+    # so that decoding overlaps with the processing of the previous frames
+    def start_decoder(self):
+        self.file.set(cv2.CAP_PROP_POS_FRAMES, self.frame_start + (self.FrameIndex + 1) * self.frame_step)
+        self.frame_queue = queue.Queue(maxsize=2 * self.buffer_size)
+        self.decoder_stop = threading.Event()
+        self.decoder = threading.Thread(target=self.decode_frames, daemon=True)
+        self.decoder.start()
+
+    def decode_frames(self):
+        for _ in range(self.FrameIndex + 1, self.FrameCount):
+            ret, img = self.file.read()
+            if not ret:
+                break
+            img = img[self.frame_roi[0], self.frame_roi[1], 1] if self.single_channel else cv2.cvtColor(img[self.frame_roi], cv2.COLOR_BGR2GRAY)
+            for _ in range(self.frame_step - 1): # skip frames outside the frame range
+                self.file.grab()
+            if not self.put_frame(img):
+                return
+        self.put_frame(None) # end of file
+
+    def put_frame(self, img):
+        while not self.decoder_stop.is_set():
+            try:
+                self.frame_queue.put(img, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def stop_decoder(self):
+        if self.decoder is not None:
+            self.decoder_stop.set()
+            self.decoder.join()
+            self.decoder = None
+
 # wrapper of video_reader which stores everything in memory
 class all_video_reader:
-    def __init__(self, file, buffer_size = 25):
-        vid_rdr = video_reader(file, buffer_size)
+    def __init__(self, file, buffer_size = 25, frame_range = None, roi_rows = None, roi_cols = None):
+        vid_rdr = video_reader(file, buffer_size, frame_range=frame_range, roi_rows=roi_rows, roi_cols=roi_cols)
         self.file = file
         self.ih = vid_rdr.ih
         self.iw = vid_rdr.iw
@@ -136,20 +258,35 @@ class all_video_reader:
         self.Height = vid_rdr.Height
         self.FrameCount = vid_rdr.FrameCount
         self.count = vid_rdr.count
+        self.col0 = vid_rdr.col0
+        self.ncols = vid_rdr.ncols
+        self.row0 = vid_rdr.row0
+        self.frame_start, self.frame_stop, self.frame_step = vid_rdr.frame_start, vid_rdr.frame_stop, vid_rdr.frame_step
+        self.flag_rotate = False # frames are rotated once while loading
+        self.infiledatatype = vid_rdr.infiledatatype
+        self.scale = vid_rdr.scale
+        self.random_access = True
         self.FrameIndex = -1
-        self.frames = np.zeros((self.FrameCount, self.ih, self.iw), dtype=np.uint16)
+        self.buffer_size = buffer_size
+        self.frames = np.zeros((self.FrameCount, self.ih, self.ncols), dtype=vid_rdr.infiledatatype) # native bit depth
         # load all frames
-        i = 0
-        self.means = np.zeros(self.FrameCount)
         while vid_rdr.has_frames():
-            frame = vid_rdr.next_frame()
-            self.means[i] = np.mean(frame)
-            self.frames[i, :, :] = frame
-            i+=1
+            i = vid_rdr.FrameIndex + 1
+            block = vid_rdr.next_frames(buffer_size)
+            self.frames[i:i + block.shape[0], :, :] = np.rot90(block, axes=(1, 2)) if vid_rdr.flag_rotate else block
+        self.means = np.mean(self.frames, axis=(1, 2))
 
     def has_frames(self):
         return self.FrameIndex + 1 < self.FrameCount
 
+    def get_frames(self, start, stop):
+        return self.frames[start:stop, :, :]
+
+    def next_frames(self, n):
+        start = self.FrameIndex + 1
+        self.FrameIndex = min(start + n, self.FrameCount) - 1
+        return self.frames[start:self.FrameIndex + 1, :, :]
+
     def next_frame(self):
         self.FrameIndex += 1
         return self.frames[self.FrameIndex, :, :]
@@ -157,6 +294,68 @@ class all_video_reader:
     def reset(self):
         self.FrameIndex = -1
 
-    
-    
-    
+# columns [col_lo, col_hi) of the rotated image, taken from unrotated frames (the rows of the frames)
+def column_band(frames, col_lo, col_hi, flag_rotate):
+    return frames[..., col_lo:col_hi, :] if flag_rotate else frames[..., col_lo:col_hi]
+
+# wrapper of video_reader which keeps a copy of the columns [col_lo, col_hi) of every frame read,
+# so that a second pass over the video can be served from memory without re-reading the file
+class band_video_reader:
+    def __init__(self, rdr, col_lo, col_hi):
+        self.rdr = rdr
+        self.file = rdr.file
+        self.ih = rdr.ih
+        self.iw = rdr.iw
+        self.Width = rdr.Width
+        self.Height = rdr.Height
+        self.FrameCount = rdr.FrameCount
+        self.count = rdr.count
+        self.infiledatatype = rdr.infiledatatype
+        self.scale = rdr.scale
+        self.buffer_size = rdr.buffer_size
+        self.col0 = rdr.col0 # frames of rdr are returned during the first pass
+        self.ncols = rdr.ncols
+        self.col_lo, self.col_hi = col_lo, col_hi
+        self.flag_rotate = rdr.flag_rotate
+        self.random_access = rdr.random_access
+        self.FrameIndex = -1
+        self.cached = False
+        band_shape = (col_hi - col_lo, self.ih) if self.flag_rotate else (self.ih, col_hi - col_lo)
+        self.cache = np.zeros((self.FrameCount,) + band_shape, dtype=rdr.infiledatatype)
+
+    def has_frames(self):
+        return self.FrameIndex + 1 < self.FrameCount
+
+    def get_frames(self, start, stop):
+        if self.cached:
+            return self.cache[start:stop, :, :]
+        block = self.rdr.get_frames(start, stop)
+        self.cache[start:stop] = column_band(block, self.col_lo - self.rdr.col0, self.col_hi - self.rdr.col0, self.flag_rotate)
+        return block
+
+    def next_frames(self, n):
+        start = self.FrameIndex + 1
+        if self.cached:
+            self.FrameIndex = min(start + n, self.FrameCount) - 1
+            return self.cache[start:self.FrameIndex + 1, :, :]
+        block = self.rdr.next_frames(n)
+        self.FrameIndex = self.rdr.FrameIndex
+        self.cache[start:self.FrameIndex + 1] = column_band(block, self.col_lo - self.rdr.col0, self.col_hi - self.rdr.col0, self.flag_rotate)
+        return block
+
+    def next_frame(self):
+        return self.next_frames(1)[0]
+
+    def covers(self, col_lo, col_hi):
+        return self.col_lo <= col_lo and col_hi <= self.col_hi
+
+    # after a complete first pass, frames are served from the cache and only contain
+    # the columns of the band (starting at col0)
+    def reset(self):
+        if not self.has_frames():
+            self.cached = True
+            self.col0 = self.col_lo
+            self.ncols = self.col_hi - self.col_lo
+        elif not self.cached:
+            self.rdr.reset()
+        self.FrameIndex = -1